@@ -1,12 +1,165 @@
+import json
+import math
+import time
+import gzip
+import hashlib
 from uuid import uuid4
-from flask import Flask, render_template, session
+from threading import Lock
+
+from redis import StrictRedis
+from flask import Flask, Response, abort, render_template, request, session
 
 from util import is_uuid
+from wave_func import WaveFunc
+from node_filter import NodeFilter
+from data_proxy.redis import RedisProxy
 
 app = Flask(__name__)
 app.debug = True
 app.config['SECRET_KEY'] = 'secret!'
 
+redis = StrictRedis(host='redis', db=0)
+redis_proxy = RedisProxy(redis)
+
+# Unknown nodes are answered without going to redis
+node_filter = NodeFilter(redis_proxy)
+
+# Seconds a response is served from memory without going to redis at all
+CACHE_TTL = 2
+
+# Smaller responses aren't worth compressing
+GZIP_MIN_SIZE = 1024
+
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+CURVE_MAX_SAMPLES = 1440
+
+
+class TTLCache(object):
+    '''
+    In-process response cache. Entries stay usable past their TTL as the body for a matching
+    ETag, so a revalidated response isn't rebuilt.
+
+    :param ttl: seconds an entry is fresh
+    :param max_entries: the oldest entries are evicted beyond this
+    '''
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        '''
+        :returns: (fresh, entry) or (False, None)
+        '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        return time.time() < entry['expires'], entry
+
+    def set(self, key, etag, body):
+        entry = {
+            'expires': time.time() + self.ttl,
+            'etag': etag,
+            'body': body,
+            'gzip': None
+        }
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+
+        return entry
+
+    def touch(self, entry):
+        entry['expires'] = time.time() + self.ttl
+        return entry
+
+
+response_cache = TTLCache(CACHE_TTL)
+
+
+def get_stream_id(client, stream_key):
+    '''
+    :returns: the latest entry id, or None if the stream is empty
+    '''
+
+    entries = client.xrevrange(stream_key, max='+', min='-', count=1)
+    return entries[0][0].decode() if entries else None
+
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()[:20]
+
+
+def cached_response(cache_key, get_state, build):
+    '''
+    Serve a read through the response cache.
+
+    A fresh entry is returned as is. Otherwise get_state() is called for the cheap id of the data
+    the response depends on, and the body is only rebuilt with build() if that changed.
+    Conditional requests matching the ETag get a 304, and large bodies are gzipped for clients
+    that accept it.
+
+    :param get_state: returns the state id, or None if the resource doesn't exist
+    :param build: returns the response as a JSON-serializable value
+    '''
+
+    fresh, entry = response_cache.get(cache_key)
+    if not fresh:
+        state_id = get_state()
+        if state_id is None:
+            abort(404)
+
+        etag = make_etag(state_id, *cache_key)
+        if entry and entry['etag'] == etag:
+            response_cache.touch(entry)
+        else:
+            body = json.dumps(build(), separators=(',', ':')).encode()
+            entry = response_cache.set(cache_key, etag, body)
+
+    headers = {
+        'ETag': '"%s"' % entry['etag'],
+        'Cache-Control': 'max-age=%d' % CACHE_TTL,
+        'Vary': 'Accept-Encoding'
+    }
+
+    if request.if_none_match.contains(entry['etag']):
+        return Response(status=304, headers=headers)
+
+    body = entry['body']
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        if entry['gzip'] is None:
+            entry['gzip'] = gzip.compress(body, compresslevel=6)
+        body = entry['gzip']
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def get_arg(name, default=None, cast=float, minimum=None, maximum=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+
+    try:
+        value = cast(value)
+    except ValueError:
+        abort(400)
+
+    if minimum is not None and value < minimum:
+        abort(400)
+    if maximum is not None:
+        value = min(value, maximum)
+
+    return value
+
 
 @app.route('/node/<node_uuid>')
 def index(node_uuid):
@@ -24,6 +177,136 @@ def index(node_uuid):
     })
 
 
+@app.route('/api/node/<node_uuid>')
+def api_node(node_uuid):
+    if not is_uuid(node_uuid):
+        abort(400)
+
+    if not redis_proxy.might_exist(node_uuid):
+        abort(404)
+
+    client = redis_proxy.get_client(node_uuid)
+
+    def get_state():
+        # Connections and points move the stream, saves move the version
+        version = redis_proxy.get_node_version(client, redis_proxy.get_node_key(node_uuid))
+        if version is None:
+            return None
+        stream_key = redis_proxy.get_node_stream_key(node_uuid)
+        return '%s.%s' % (get_stream_id(client, stream_key) or '0-0', version)
+
+    def build():
+        node_def = redis_proxy.load_nodes([node_uuid])[node_uuid]
+        if node_def is None:
+            abort(404)
+        return node_def
+
+    return cached_response(('node', node_uuid), get_state, build)
+
+
+@app.route('/api/node/<node_uuid>/history')
+def api_history(node_uuid):
+    '''
+    Points newest first, a page at a time. Pass the returned 'next' as 'before' for the next
+    page.
+    '''
+
+    if not is_uuid(node_uuid):
+        abort(400)
+
+    before = get_arg('before')
+    window = get_arg('window', minimum=0)
+    limit = get_arg('limit', HISTORY_PAGE_SIZE, cast=int, minimum=1,
+                    maximum=HISTORY_MAX_PAGE_SIZE)
+
+    client = redis_proxy.get_client(node_uuid)
+
+    # A window ending now moves without any write, so it's anchored to the end of the current
+    # cache period and the anchor is part of the state
+    anchor_timestamp = before
+    if anchor_timestamp is None and window is not None:
+        anchor_timestamp = math.ceil(time.time() / CACHE_TTL) * CACHE_TTL
+
+    def get_state():
+        stream_id = get_stream_id(client, redis_proxy.get_node_stream_key(node_uuid)) or '0-0'
+        if before is None and window is not None:
+            return '%s@%d' % (stream_id, anchor_timestamp)
+        return stream_id
+
+    def build():
+        anchor = time.time() if anchor_timestamp is None else anchor_timestamp
+        history = redis_proxy.get_histories([node_uuid], anchor_timestamp=anchor,
+                                            window=window, limit=limit + 1)[node_uuid]
+
+        # The extra point starts the next page
+        next_before = None
+        if len(history['uuid']) > limit:
+            next_before = history['timestamp_epoch'][limit]
+
+        return {
+            'uuid': [u.decode() for u in history['uuid'][:limit]],
+            'timestamp_epoch': history['timestamp_epoch'][:limit],
+            'next': next_before
+        }
+
+    return cached_response(('history', node_uuid, before, window, limit), get_state, build)
+
+
+@app.route('/api/node/<node_uuid>/signal')
+def api_signal(node_uuid):
+    if not is_uuid(node_uuid):
+        abort(400)
+
+    client = redis_proxy.get_client(node_uuid)
+
+    def get_state():
+        return get_stream_id(client, redis_proxy.get_node_signal_key(node_uuid))
+
+    def build():
+        return redis_proxy.get_signal(node_uuid)
+
+    return cached_response(('signal', node_uuid), get_state, build)
+
+
+@app.route('/api/node/<node_uuid>/curve')
+def api_curve(node_uuid):
+    '''
+    The node's current wave function sampled on a grid, 'num' samples 'step' seconds apart from
+    'start' (by default the current step)
+    '''
+
+    if not is_uuid(node_uuid):
+        abort(400)
+
+    step = get_arg('step', 60, minimum=1)
+    num_samples = get_arg('num', 60, cast=int, minimum=1, maximum=CURVE_MAX_SAMPLES)
+    start = get_arg('start')
+    if start is None:
+        # Aligned, so requests within a step share a cache entry
+        start = math.floor(time.time() / step) * step
+
+    client = redis_proxy.get_client(node_uuid)
+
+    def get_state():
+        return get_stream_id(client, redis_proxy.get_node_signal_key(node_uuid))
+
+    def build():
+        wave_func_def = redis_proxy.get_signal(node_uuid)
+
+        values = []
+        if wave_func_def and wave_func_def.get('period'):
+            wave_func = WaveFunc(serialized=wave_func_def)
+            values = [wave_func.resolve(start + i * step).value for i in range(num_samples)]
+
+        return {
+            'start': start,
+            'step': step,
+            'values': values
+        }
+
+    return cached_response(('curve', node_uuid, start, step, num_samples), get_state, build)
+
+
 if __name__ == '__main__':
     try:
         app.run(debug=True, host='0.0.0.0', port=7010, threaded=True, use_reloader=False)
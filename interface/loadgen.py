@@ -0,0 +1,334 @@
+#!/usr/bin/python
+
+import sys
+import time
+import heapq
+import random
+import argparse
+import threading
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+
+import socketio
+
+
+NAMESPACE = '/signals'
+
+
+def read_proc_status(pid='self'):
+    '''
+    :returns: (threads, resident memory in MB), or (None, None) if the process isn't readable
+    '''
+
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except (IOError, OSError):
+        return None, None
+
+    return int(status['Threads']), int(status['VmRSS'].split()[0]) / 1024.0
+
+
+def percentile(values, pct):
+    '''
+    :param values: sorted list
+    '''
+
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class LoadStats(object):
+    '''
+    Counters and latencies shared by every simulated client. A point's latency is from its
+    AddPoint emit to the receipt of a signal whose ref_time is that point's time, once per
+    subscribed client.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # (node_uuid, point time in ms) -> emit time
+        self.sent = {}
+
+        self.num_connected = 0
+        self.num_connect_errors = 0
+        self.num_sent = 0
+        self.num_signals = 0
+        self.num_matched = 0
+        self.latencies = []
+
+    def on_sent(self, node_uuid, point_ms):
+        with self.lock:
+            self.sent[(node_uuid, point_ms)] = time.time()
+            self.num_sent += 1
+
+    def on_signal(self, node_uuid, ref_time):
+        now = time.time()
+        with self.lock:
+            self.num_signals += 1
+            sent_time = self.sent.get((node_uuid, int(round(ref_time * 1000))))
+            if sent_time is not None:
+                self.num_matched += 1
+                self.latencies.append(now - sent_time)
+
+    def take(self):
+        '''
+        :returns: counters since the previous take, with the latencies sorted
+        '''
+
+        with self.lock:
+            snapshot = {
+                'connected': self.num_connected,
+                'connect_errors': self.num_connect_errors,
+                'sent': self.num_sent,
+                'signals': self.num_signals,
+                'matched': self.num_matched,
+                'latencies': sorted(self.latencies)
+            }
+            self.num_sent = self.num_signals = self.num_matched = 0
+            self.latencies = []
+
+            # Points still unanswered after a minute won't be
+            cutoff = time.time() - 60
+            self.sent = dict((k, v) for k, v in self.sent.items() if v > cutoff)
+
+        return snapshot
+
+
+class LoadClient(object):
+    '''
+    One simulated browser: a socket.io connection subscribed to a node's signal, adding points to
+    that node
+    '''
+
+    def __init__(self, stats, url, node_uuid, socketio_path='socket.io', transports=None):
+        self.stats = stats
+        self.url = url
+        self.node_uuid = node_uuid
+        self.session_id = str(uuid4())
+        self.socketio_path = socketio_path
+        self.transports = transports
+
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('signal', self.on_signal, namespace=NAMESPACE)
+
+    def connect(self):
+        try:
+            self.sio.connect(self.url, namespaces=[NAMESPACE], transports=self.transports,
+                             socketio_path=self.socketio_path)
+            self.emit('SignalConnectionInit', {})
+        except Exception as e:
+            print('Connect failed: %s' % e)
+            with self.stats.lock:
+                self.stats.num_connect_errors += 1
+            return False
+
+        with self.stats.lock:
+            self.stats.num_connected += 1
+        return True
+
+    def emit(self, msg, data):
+        data['session_id'] = self.session_id
+        data['node_uuid'] = self.node_uuid
+        self.sio.emit('event', {'msg': msg, 'data': data}, namespace=NAMESPACE)
+
+    def add_point(self, point_ms):
+        self.stats.on_sent(self.node_uuid, point_ms)
+        self.emit('AddPoint', {'point_time': point_ms})
+
+    def on_signal(self, msg):
+        signal = msg.get('data') if type(msg) is dict else None
+        if signal and 'ref_time' in signal:
+            self.stats.on_signal(self.node_uuid, signal['ref_time'])
+
+    def disconnect(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+class LoadGenerator(object):
+    '''
+    Simulates num_clients socket.io clients spread evenly over num_nodes nodes, so each node has
+    num_clients / num_nodes subscribers (its fan-in). Each client adds points at `rate` per
+    second on average (Poisson arrivals), all scheduled from a single thread.
+
+    :param url: signal server, e.g. http://localhost:7011
+    :param ramp: seconds over which the clients connect
+    :param server_pid: signal_server.py pid, to report its threads and memory when local
+    '''
+
+    def __init__(self, url, num_clients=100, num_nodes=10, rate=0.2, duration=60, ramp=10,
+                 report_interval=5, connect_workers=20, socketio_path='socket.io',
+                 transports=None, server_pid=None):
+        self.url = url
+        self.num_clients = num_clients
+        self.num_nodes = num_nodes
+        self.rate = rate
+        self.duration = duration
+        self.ramp = ramp
+        self.report_interval = report_interval
+        self.connect_workers = connect_workers
+        self.socketio_path = socketio_path
+        self.transports = transports
+        self.server_pid = server_pid
+
+        self.stats = LoadStats()
+        self.queue = []
+        self.schedule_lock = threading.Lock()
+        self.node_uuids = [str(uuid4()) for _ in range(num_nodes)]
+        self.clients = []
+        self.running = True
+
+        # node_uuid -> last point time in ms, kept unique per node so signals can be matched
+        self.last_point_ms = {}
+
+        self.all_latencies = []
+        self.totals = {'sent': 0, 'signals': 0, 'matched': 0}
+
+    def next_point_ms(self, node_uuid):
+        point_ms = max(int(time.time() * 1000), self.last_point_ms.get(node_uuid, 0) + 1)
+        self.last_point_ms[node_uuid] = point_ms
+        return point_ms
+
+    def connect_all(self):
+        delay = self.ramp / float(self.num_clients) if self.num_clients else 0
+        start_time = time.time()
+
+        def connect(i):
+            time.sleep(max(0, start_time + i * delay - time.time()))
+            if self.running and self.clients[i].connect():
+                self.schedule(self.clients[i])
+
+        with ThreadPoolExecutor(max_workers=self.connect_workers) as executor:
+            list(executor.map(connect, range(self.num_clients)))
+
+    def schedule(self, client):
+        with self.schedule_lock:
+            heapq.heappush(self.queue, (time.time() + random.expovariate(self.rate),
+                                        id(client), client))
+
+    def send_points(self):
+        while self.running:
+            with self.schedule_lock:
+                due = self.queue and self.queue[0][0] <= time.time()
+                if due:
+                    _, _, client = heapq.heappop(self.queue)
+
+            if not due:
+                time.sleep(0.005)
+                continue
+
+            try:
+                client.add_point(self.next_point_ms(client.node_uuid))
+            except Exception as e:
+                print('Send failed: %s' % e)
+                continue
+            self.schedule(client)
+
+    def report(self, elapsed, interval):
+        snapshot = self.stats.take()
+        latencies = snapshot['latencies']
+        self.all_latencies.extend(latencies)
+        for key in self.totals:
+            self.totals[key] += snapshot[key]
+
+        def ms(value):
+            return '%.1f' % (value * 1000) if value is not None else '-'
+
+        threads, rss = read_proc_status()
+        line = ('%5.0fs clients %d (%d failed)  sent %.1f/s  signals %.1f/s  matched %.1f/s  '
+                'latency ms p50 %s p90 %s p99 %s max %s  loadgen threads %s rss %.0fMB') % (
+            elapsed, snapshot['connected'], snapshot['connect_errors'],
+            snapshot['sent'] / interval, snapshot['signals'] / interval,
+            snapshot['matched'] / interval,
+            ms(percentile(latencies, 50)), ms(percentile(latencies, 90)),
+            ms(percentile(latencies, 99)), ms(latencies[-1] if latencies else None),
+            threads, rss or 0)
+
+        if self.server_pid:
+            server_threads, server_rss = read_proc_status(self.server_pid)
+            if server_threads is not None:
+                line += '  server threads %d rss %.0fMB' % (server_threads, server_rss)
+
+        print(line)
+
+    def run(self):
+        '''
+        :returns: dict of the totals and overall latency percentiles in seconds
+        '''
+
+        self.clients = [LoadClient(self.stats, self.url, self.node_uuids[i % self.num_nodes],
+                                   socketio_path=self.socketio_path, transports=self.transports)
+                        for i in range(self.num_clients)]
+
+        connector = threading.Thread(target=self.connect_all, daemon=True)
+        sender = threading.Thread(target=self.send_points, daemon=True)
+        connector.start()
+        sender.start()
+
+        start_time = last_report = time.time()
+        try:
+            while time.time() - start_time < self.duration:
+                time.sleep(min(self.report_interval,
+                               max(0, self.duration - (time.time() - start_time))))
+                now = time.time()
+                self.report(now - start_time, now - last_report)
+                last_report = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            for client in self.clients:
+                client.disconnect()
+
+        latencies = sorted(self.all_latencies)
+        summary = dict(self.totals)
+        summary['seconds'] = time.time() - start_time
+        for pct in (50, 90, 99):
+            summary['p%d' % pct] = percentile(latencies, pct)
+        summary['max'] = latencies[-1] if latencies else None
+
+        return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for signal_server.py')
+    parser.add_argument('--url', default='http://localhost:7011')
+    parser.add_argument('--socketio-path', default='socket.io',
+                        help='signal_socket when going through nginx')
+    parser.add_argument('--transport', action='append', choices=('websocket', 'polling'),
+                        help='Default lets the client upgrade from polling')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--nodes', type=int, default=10,
+                        help='Clients are spread over this many nodes')
+    parser.add_argument('--rate', type=float, default=0.2, help='Points per second per client')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--ramp', type=float, default=10, help='Seconds to connect all clients')
+    parser.add_argument('--report-interval', type=float, default=5)
+    parser.add_argument('--connect-workers', type=int, default=20)
+    parser.add_argument('--server-pid', type=int, default=None)
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.url,
+                              num_clients=args.clients,
+                              num_nodes=args.nodes,
+                              rate=args.rate,
+                              duration=args.duration,
+                              ramp=args.ramp,
+                              report_interval=args.report_interval,
+                              connect_workers=args.connect_workers,
+                              socketio_path=args.socketio_path,
+                              transports=args.transport,
+                              server_pid=args.server_pid)
+
+    summary = generator.run()
+    print('Total: sent %d, signals %d, matched %d in %.0fs' % (
+        summary['sent'], summary['signals'], summary['matched'], summary['seconds']))
+    for key in ('p50', 'p90', 'p99', 'max'):
+        if summary[key] is not None:
+            print('  %s %.1fms' % (key, summary[key] * 1000))
+    sys.exit(0)
@@ -0,0 +1,194 @@
+import time
+import traceback
+from collections import deque
+from threading import Thread, Lock
+
+
+class RateLimiter(object):
+    '''
+    Token buckets keyed by an arbitrary id, e.g. a session or a node. Each key earns `rate`
+    tokens per second up to `burst`. Keys that have refilled completely are pruned, as a full
+    bucket is the same as no bucket.
+
+    :param rate: tokens per second
+    :param burst: bucket size
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        # key -> [tokens, last refill time]
+        self.buckets = {}
+
+    def available(self, key, now=None):
+        '''
+        Refill the key's bucket and return its tokens
+        '''
+
+        if now is None:
+            now = time.time()
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        return bucket[0]
+
+    def consume(self, key, cost=1):
+        self.buckets[key][0] -= cost
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+
+        for key, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self.buckets[key]
+
+
+class IngestLimiter(object):
+    '''
+    Admission control for points arriving over the socket.
+
+    A point is written immediately only if both its session and its node have a token, and the
+    session has nothing deferred. Otherwise it is deferred. Each flush takes every session's
+    oldest deferred points, as many as it has tokens, and writes the points taken for a node as
+    one batch, so a burst against a node costs one write and one signal recompute per flush
+    interval rather than one per point, and no session writes faster than session_rate. A
+    session's deferred points are capped across flushes, and points over the cap are dropped.
+
+    :param write_batch: callable(node_uuid, timestamps) persisting a deferred batch
+    :param session_rate: points per second per session before deferring
+    :param session_burst:
+    :param node_rate: points per second per node before deferring
+    :param node_burst:
+    :param max_pending: deferred points held per session
+    :param flush_interval: seconds between flushes of the deferred points
+    '''
+
+    ACCEPTED = 'accepted'
+    DEFERRED = 'deferred'
+    DROPPED = 'dropped'
+
+    def __init__(self, write_batch, session_rate=5, session_burst=20, node_rate=20,
+                 node_burst=50, max_pending=200, flush_interval=1.0):
+        self.write_batch = write_batch
+        self.session_limiter = RateLimiter(session_rate, session_burst)
+        self.node_limiter = RateLimiter(node_rate, node_burst)
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+
+        self.lock = Lock()
+
+        # session_id -> deque of (node_uuid, timestamp), oldest first
+        self.pending = {}
+
+        self.metrics = {
+            'accepted': 0,
+            'deferred': 0,
+            'dropped': 0,
+            'session_limited': 0,
+            'node_limited': 0,
+            'flushed_points': 0,
+            'flushed_batches': 0,
+            'flush_errors': 0
+        }
+
+    def submit(self, session_id, node_uuid, timestamp):
+        '''
+        :returns: ACCEPTED if the caller should write the point now, DEFERRED if it's queued
+            for the next flush, or DROPPED
+        '''
+
+        with self.lock:
+            now = time.time()
+            queue = self.pending.get(session_id)
+            session_ok = not queue and self.session_limiter.available(session_id, now) >= 1
+            node_ok = self.node_limiter.available(node_uuid, now) >= 1
+
+            if session_ok and node_ok:
+                self.session_limiter.consume(session_id)
+                self.node_limiter.consume(node_uuid)
+                self.metrics['accepted'] += 1
+                return self.ACCEPTED
+
+            if not session_ok:
+                self.metrics['session_limited'] += 1
+            if not node_ok:
+                self.metrics['node_limited'] += 1
+
+            if queue is None:
+                queue = self.pending[session_id] = deque()
+            elif len(queue) >= self.max_pending:
+                self.metrics['dropped'] += 1
+                return self.DROPPED
+
+            queue.append((node_uuid, timestamp))
+            self.metrics['deferred'] += 1
+            return self.DEFERRED
+
+    def flush(self):
+        '''
+        Write the deferred points the sessions have tokens for, a batch per node
+
+        :returns: number of points written
+        '''
+
+        batches = {}
+        with self.lock:
+            now = time.time()
+            for session_id, queue in list(self.pending.items()):
+                num_taken = min(len(queue), int(self.session_limiter.available(session_id, now)))
+                if num_taken:
+                    self.session_limiter.consume(session_id, num_taken)
+
+                for _ in range(num_taken):
+                    node_uuid, timestamp = queue.popleft()
+                    batches.setdefault(node_uuid, []).append(timestamp)
+
+                if not queue:
+                    del self.pending[session_id]
+
+            self.session_limiter.prune(now)
+            self.node_limiter.prune(now)
+
+        num_points = 0
+        for node_uuid, timestamps in batches.items():
+            try:
+                self.write_batch(node_uuid, timestamps)
+            except Exception:
+                # TODO: Setup a proper log sink
+                traceback.print_exc()
+                self.metrics['flush_errors'] += 1
+                continue
+
+            num_points += len(timestamps)
+            self.metrics['flushed_points'] += len(timestamps)
+            self.metrics['flushed_batches'] += 1
+
+        return num_points
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics['pending_points'] = sum(len(q) for q in self.pending.values())
+            metrics['pending_sessions'] = len(self.pending)
+            metrics['session_buckets'] = len(self.session_limiter.buckets)
+            metrics['node_buckets'] = len(self.node_limiter.buckets)
+
+        return metrics
+
+    def start(self):
+        flusher = Thread(target=self.run)
+        flusher.daemon = True
+        flusher.start()
+        return flusher
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
@@ -3,6 +3,7 @@
 from gevent import monkey
 monkey.patch_all()
 
+import os
 import time
 import json
 from threading import Thread
@@ -12,33 +13,70 @@ from flask import Flask, request
 from flask_socketio import SocketIO, emit, disconnect, join_room, leave_room
 
 from util import is_uuid
+from rate_limit import IngestLimiter
+from node_filter import NodeFilter
+from data_proxy.redis import RedisProxy
+from aggregate_signal import AggregateSignal
+from score_recorder import track_activity
 
 app = Flask(__name__)
 app.debug = True
 app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app)
 
-redis = StrictRedis(host='redis', db=0)
+redis = StrictRedis(host=os.environ.get('REDIS_HOST', 'redis'), db=0)
+redis_proxy = RedisProxy(redis)
+
+# New nodes are created without reading them first when points arrive
+node_filter = NodeFilter(redis_proxy)
+
+# When set, signals are recomputed by kernel/signal_worker.py rather than on the write path
+SIGNAL_WORKER = bool(os.environ.get('SIGNAL_WORKER'))
+
+if not SIGNAL_WORKER:
+    # Signals are published from here, so this is where nodes become active for the recorder and
+    # where the aggregates see their members' new signals
+    track_activity(redis_proxy)
+    AggregateSignal(redis_proxy)
 
 
 class SignalInterface(object):
-    def __init__(self, redis, socketio):
-        self.redis = redis
+    def __init__(self, data_proxy, socketio):
+        self.data_proxy = data_proxy
         self.socketio = socketio
 
         self.namespace_map = {}
         self.signal_listeners = {}
 
-    def listen(self, node_uuid, debug=False):
-        signal_listener = self.signal_listeners.get(node_uuid)
+    def get_room(self, node_uuid, aggregate=False):
+        # Aggregate subscribers get their own room, the payload differs
+        if aggregate:
+            return 'AGG-%s' % node_uuid
+        return node_uuid
+
+    def listen(self, node_uuid, debug=False, aggregate=False):
+        room = self.get_room(node_uuid, aggregate=aggregate)
+        signal_listener = self.signal_listeners.get(room)
         if not signal_listener:
-            signal_listener = SignalListener(self.socketio, self.redis, node_uuid, self.send_signal, debug=debug)
+            if aggregate:
+                client = self.data_proxy.redis
+                signal_key = self.data_proxy.get_aggregate_signal_key(node_uuid)
+                signal_field = b'curve'
+                msg_type = 'AggregateCurve'
+            else:
+                client = self.data_proxy.get_client(node_uuid)
+                signal_key = self.data_proxy.get_node_signal_key(node_uuid)
+                signal_field = b'wave_func'
+                msg_type = 'WaveFunc'
+
+            signal_listener = SignalListener(self.socketio, client, room, signal_key,
+                                             signal_field, msg_type, self.send_signal, debug=debug)
             signal_listener.start()
-            self.signal_listeners[node_uuid] = signal_listener
+            self.signal_listeners[room] = signal_listener
         return signal_listener
 
-    def get_listener(self, node_uuid):
-        return self.signal_listeners.get(node_uuid)
+    def get_listener(self, room):
+        return self.signal_listeners.get(room)
 
     def get_namespace(self, node_uuid):
         key = node_uuid
@@ -48,47 +86,53 @@ class SignalInterface(object):
         key = node_uuid
         self.namespace_map[key] = namespace
 
-    def construct_message(self, node_uuid, signal=None):
-        if not signal:
-            listener = self.get_listener(node_uuid)
-            if listener:
-                signal = listener.wave_func
+    def construct_message(self, room, signal=None):
+        msg_type = 'WaveFunc'
+        listener = self.get_listener(room)
+        if listener:
+            msg_type = listener.msg_type
+            if not signal:
+                signal = listener.signal
 
         if signal:
             return {
-                'type': 'WaveFunc',
+                'type': msg_type,
                 'version': '0.01',
                 'action': 'Update',
                 'data': signal
             }
 
-    def send_signal(self, node_uuid, signal):
-        msg = self.construct_message(node_uuid, signal)
+    def send_signal(self, room, signal):
+        msg = self.construct_message(room, signal)
         print('msg', msg)
         if msg:
-            socketio.emit('signal', msg, namespace='/signals', room=node_uuid)
+            socketio.emit('signal', msg, namespace='/signals', room=room)
 
 
 class SignalListener(Thread):
-    def __init__(self, socketio, redis, node_uuid, send_callback, debug=False):
+    def __init__(self, socketio, redis, room, signal_key, signal_field, msg_type, send_callback,
+                 debug=False):
         Thread.__init__(self)
 
         self.socketio = socketio
         self.redis = redis
         self.daemon = True
-        self.node_uuid = node_uuid
+        self.room = room
+        self.signal_key = signal_key
+        self.signal_field = signal_field
+        self.msg_type = msg_type
         self.send_callback = send_callback
         self.debug = debug
 
-        self.wave_func = None
+        self.signal = None
 
     def run(self):
         debug = self.debug
         first_run = True
         last_stream_id = None
 
-        signal_key = 'NODE-SIGNAL-%s' % self.node_uuid
-        self.wave_func = None
+        signal_key = self.signal_key
+        self.signal = None
 
         while True:
             if first_run:
@@ -99,8 +143,8 @@ class SignalListener(Thread):
 
                 if result:
                     last_stream_id = result[0][0]
-                    wave_func_json = result[0][1][b'wave_func']
-                    self.wave_func = json.loads(wave_func_json)
+                    signal_json = result[0][1][self.signal_field]
+                    self.signal = json.loads(signal_json)
 
                 first_run = False
             else:
@@ -122,12 +166,12 @@ class SignalListener(Thread):
                         print('stream_entries', stream_entries)
 
                     for stream_id, stream_value_dict in stream_entries:
-                        wave_func_json = stream_value_dict[b'wave_func']
-                        self.wave_func = json.loads(wave_func_json)
+                        signal_json = stream_value_dict[self.signal_field]
+                        self.signal = json.loads(signal_json)
                         last_stream_id = stream_id
 
-            print('wave_func', self.wave_func)
-            self.send_callback(self.node_uuid, self.wave_func)
+            print('signal', self.signal)
+            self.send_callback(self.room, self.signal)
 
 
 @socketio.on('event', namespace='/signals')
@@ -158,36 +202,68 @@ def handle_message(message):
             print('NodeUUID required')
             return
 
+        # Subscribe to the combined signal of the node's downstream set instead
+        aggregate = bool(data.get('aggregate'))
+        room = app.signal_interface.get_room(node_uuid, aggregate=aggregate)
+
         app.signal_interface.set_namespace(node_uuid, request.namespace)
-        app.signal_interface.listen(node_uuid, debug=False)
+        app.signal_interface.listen(node_uuid, debug=False, aggregate=aggregate)
 
-        join_room(node_uuid)
+        join_room(room)
         msg = {
             'Msg': 'SignalConnectionInit',
-            'Signal': app.signal_interface.construct_message(node_uuid)
+            'Signal': app.signal_interface.construct_message(room)
         }
-        socketio.emit('control', msg, namespace='/signals', room=node_uuid)
+        socketio.emit('control', msg, namespace='/signals', room=room)
 
     elif msg_type == 'AddPoint':
-        session_id = data.get('session_id')
         node_uuid = data.get('node_uuid')
-        client_time = float(data.get('point_time')) / 1000
+        if not node_uuid or not is_uuid(node_uuid):
+            print('NodeUUID required')
+            return
+
+        try:
+            client_time = float(data.get('point_time')) / 1000
+        except (TypeError, ValueError):
+            print('Invalid point_time')
+            return
 
-        add_point(node_uuid, client_time)
-        print('Added point for %s' % node_uuid)
+        status = ingest_limiter.submit(request.sid, node_uuid, client_time)
+        if status == IngestLimiter.ACCEPTED:
+            add_point(node_uuid, client_time)
+            print('Added point for %s' % node_uuid)
+        else:
+            print('Point for %s %s' % (node_uuid, status))
 
 
 def add_point(node_uuid, point_time=None):
     import time
-    from node import Node
-    from data_proxy.redis import RedisProxy
+    from lazy_node import get_or_create
 
-    redis_proxy = RedisProxy(redis)
-    root_node = Node(redis_proxy, uuid=node_uuid, create=True)
+    root_node = get_or_create(redis_proxy, node_uuid)
 
     if not point_time:
         point_time = time.time()
-    root_node.create_point(point_time)
+    root_node.create_point(point_time, signal=not SIGNAL_WORKER)
+
+
+def add_points(node_uuid, point_times):
+    from lazy_node import get_or_create
+
+    root_node = get_or_create(redis_proxy, node_uuid)
+    root_node.create_points(point_times, signal=not SIGNAL_WORKER)
+    print('Added %d deferred points for %s' % (len(point_times), node_uuid))
+
+
+# Points over the per-session or per-node rate are deferred and written in batches
+ingest_limiter = IngestLimiter(add_points)
+
+
+@app.route('/ingest_metrics')
+def ingest_metrics():
+    metrics = ingest_limiter.get_metrics()
+    metrics['node_filter'] = node_filter.get_metrics()
+    return metrics
 
 
 @socketio.on('broadcast', namespace='/signals')
@@ -214,5 +290,6 @@ def handle_disconnect():
 
 
 if __name__ == '__main__':
-    app.signal_interface = SignalInterface(redis, socketio)
+    app.signal_interface = SignalInterface(redis_proxy, socketio)
+    ingest_limiter.start()
     socketio.run(app, host='0.0.0.0', port=7011, use_reloader=False)
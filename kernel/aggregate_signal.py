@@ -0,0 +1,308 @@
+import json
+import math
+import time
+import traceback
+from array import array
+
+from redis.exceptions import WatchError
+
+from node import Node
+from wave_func import WaveFunc
+
+
+class AggregateSignal():
+    '''
+    A combined signal for everything downstream of a root node: the sum of the members' wave
+    functions, sampled on a fixed time grid.
+
+    Each registered root keeps a hash (NODE-AGG-{uuid}) holding the grid, the summed curve, and
+    every member's own sampled curve. When a member publishes a new NodeSignal only its curve is
+    resampled, and the total is adjusted by the difference rather than recomputed from all
+    members. The total is published to NODE-AGG-SIGNAL-{uuid} for the signal server.
+
+    The grid starts at the last rebuild and spans num_samples * step seconds. Roots are rebuilt
+    once half of it has elapsed, and when a new edge extends their membership.
+
+    Deltas are only seen by the data proxy that emits them, so every process publishing signals
+    attaches an aggregate: the signal workers, the signal server when it computes signals inline,
+    and the rescore workers, which pass their batches to update_signals() instead of listening.
+
+    :param data_proxy: RedisProxy
+    :param step: seconds between samples
+    :param num_samples: grid length
+    :param roots_ttl: seconds the set of registered roots is cached in-process
+    :param listen: Follow the data proxy's deltas
+    '''
+
+    MEMBER_PREFIX = 'm:'
+
+    def __init__(self, data_proxy, step=60, num_samples=1440, roots_ttl=5, listen=True):
+        self.data_proxy = data_proxy
+        self.redis = data_proxy.redis
+        self.step = step
+        self.num_samples = num_samples
+        self.roots_ttl = roots_ttl
+
+        self._roots = None
+        self._roots_time = 0
+
+        if listen:
+            data_proxy.add_delta_listener(self.on_delta)
+
+    def roots(self, refresh=False):
+        if refresh or self._roots is None or time.time() - self._roots_time > self.roots_ttl:
+            roots_key = self.data_proxy.get_aggregate_roots_key()
+            self._roots = [r.decode() for r in self.redis.smembers(roots_key)]
+            self._roots_time = time.time()
+
+        return self._roots
+
+    def register(self, root_uuid):
+        self.redis.sadd(self.data_proxy.get_aggregate_roots_key(), root_uuid)
+        self.roots(refresh=True)
+        return self.rebuild(root_uuid)
+
+    def unregister(self, root_uuid):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.srem(self.data_proxy.get_aggregate_roots_key(), root_uuid)
+        pipe.delete(self.data_proxy.get_aggregate_key(root_uuid))
+        pipe.execute()
+        self.roots(refresh=True)
+
+    def sample(self, wave_func_def, start):
+        '''
+        :returns: array of the wave function's values on the grid, zeros if there's no signal
+        '''
+
+        values = array('d', [0.0]) * self.num_samples
+        if not wave_func_def or not wave_func_def.get('period'):
+            return values
+
+        wave_func = WaveFunc(serialized=wave_func_def)
+        for i in range(self.num_samples):
+            values[i] = wave_func.resolve(start + i * self.step).value
+
+        return values
+
+    def rebuild(self, root_uuid):
+        '''
+        Resample every member onto a fresh grid and publish
+
+        :returns: number of members
+        '''
+
+        root_node = Node(self.data_proxy, uuid=root_uuid, load=True)
+        member_uuids = list(root_node.query_outgoing())
+        signals = self.data_proxy.get_signals(member_uuids)
+
+        start = math.floor(time.time() / self.step) * self.step
+        total = array('d', [0.0]) * self.num_samples
+
+        mapping = {
+            'start': start,
+            'step': self.step
+        }
+        for member_uuid in member_uuids:
+            values = self.sample(signals[member_uuid], start)
+            for i in range(self.num_samples):
+                total[i] += values[i]
+            mapping[self.MEMBER_PREFIX + member_uuid] = values.tobytes()
+        mapping['curve'] = total.tobytes()
+
+        aggregate_key = self.data_proxy.get_aggregate_key(root_uuid)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(aggregate_key)
+        pipe.hset(aggregate_key, mapping=mapping)
+        self.queue_publish(pipe, root_uuid, start, total, len(member_uuids))
+        pipe.execute()
+
+        return len(member_uuids)
+
+    def add_members(self, root_uuid, member_uuids):
+        '''
+        Fold new members into the total without resampling the existing ones
+
+        :returns: number of members added
+        '''
+
+        signals = self.data_proxy.get_signals(member_uuids)
+        for member_uuid in member_uuids:
+            if not self.update_member(root_uuid, member_uuid, signals[member_uuid], add=True):
+                # Rebuilt from scratch, which covered the rest too
+                break
+
+        return len(member_uuids)
+
+    def update_member(self, root_uuid, member_uuid, wave_func_def, add=False, retries=5):
+        '''
+        Swap one member's curve into the total, atomically with respect to other updaters
+
+        :param add: The member is new to the root, so it has no curve yet
+        :returns: True if updated, False if the root needed (and got) a full rebuild
+        '''
+
+        aggregate_key = self.data_proxy.get_aggregate_key(root_uuid)
+        member_field = self.MEMBER_PREFIX + member_uuid
+
+        for _ in range(retries):
+            with self.redis.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(aggregate_key)
+                    start, total, old_values = pipe.hmget(aggregate_key,
+                                                          ['start', 'curve', member_field])
+                    missing = old_values is None and not add
+                    if start is None or missing or self.expired(float(start)):
+                        pipe.reset()
+                        self.rebuild(root_uuid)
+                        return False
+
+                    start = float(start)
+                    total = array('d', total)
+                    if old_values:
+                        old = array('d', old_values)
+                    else:
+                        old = array('d', [0.0]) * self.num_samples
+
+                    new = self.sample(wave_func_def, start)
+                    for i in range(self.num_samples):
+                        total[i] += new[i] - old[i]
+
+                    pipe.multi()
+                    pipe.hset(aggregate_key, mapping={
+                        'curve': total.tobytes(),
+                        member_field: new.tobytes()
+                    })
+                    self.queue_publish(pipe, root_uuid, start, total)
+                    pipe.execute()
+                    return True
+                except WatchError:
+                    continue
+
+        # Heavily contended, start over from the members
+        self.rebuild(root_uuid)
+        return False
+
+    def queue_publish(self, pipe, root_uuid, start, total, num_members=None):
+        curve = {
+            'start': start,
+            'step': self.step,
+            'values': list(total)
+        }
+        if num_members is not None:
+            curve['members'] = num_members
+
+        pipe.xadd(self.data_proxy.get_aggregate_signal_key(root_uuid),
+                  {'curve': json.dumps(curve)}, maxlen=1, approximate=False)
+
+    def expired(self, start):
+        return time.time() >= start + (self.num_samples * self.step) / 2.0
+
+    def membership(self, member_uuids):
+        '''
+        :returns: dict of root_uuid -> list of flags, whether each member belongs to the root
+        '''
+
+        roots = self.roots()
+        pipe = self.redis.pipeline(transaction=False)
+        for root_uuid in roots:
+            aggregate_key = self.data_proxy.get_aggregate_key(root_uuid)
+            for member_uuid in member_uuids:
+                pipe.hexists(aggregate_key, self.MEMBER_PREFIX + member_uuid)
+        results = pipe.execute()
+
+        n = len(member_uuids)
+        return dict((root_uuid, results[i * n:(i + 1) * n]) for i, root_uuid in enumerate(roots))
+
+    def on_delta(self, action, **kwargs):
+        if action not in ('NodeSignal', 'AddOutgoingConnection') or not self.roots():
+            return
+
+        node_uuid = kwargs['node_uuid']
+
+        if action == 'NodeSignal':
+            self.update_signals({node_uuid: kwargs['wave_func']})
+
+        elif action == 'AddOutgoingConnection':
+            self.add_edge(node_uuid, kwargs['outgoing_node_uuid'])
+
+    def update_signals(self, signals):
+        '''
+        Swap the curves of the members among newly published signals, with one membership read
+
+        :param signals: dict of node_uuid -> wave_func serialized as dict, or None for a removed
+            signal
+        :returns: number of member curves updated
+        '''
+
+        if not signals or not self.roots():
+            return 0
+
+        node_uuids = list(signals)
+        num_updated = 0
+        for root_uuid, flags in self.membership(node_uuids).items():
+            for node_uuid, is_member in zip(node_uuids, flags):
+                if not is_member:
+                    continue
+
+                if not self.update_member(root_uuid, node_uuid, signals[node_uuid]):
+                    # Rebuilt from the published signals, which covered the rest too
+                    break
+                num_updated += 1
+
+        return num_updated
+
+    def add_edge(self, from_uuid, to_uuid):
+        '''
+        Add to_uuid and its descendants to every root that has from_uuid but not to_uuid
+
+        Edges written by other processes arrive here through SignalWorker.add_edges. An edge
+        applied twice is a no-op, as the target is a member by then.
+
+        :returns: list of the roots updated
+        '''
+
+        if not self.roots():
+            return []
+
+        # The new members are found from the target rather than by traversing from the root
+        membership = self.membership([from_uuid, to_uuid])
+
+        updated = []
+        new_member_uuids = None
+        for root_uuid, (has_from, has_to) in membership.items():
+            if not has_from or has_to:
+                continue
+
+            if new_member_uuids is None:
+                new_member_uuids = self.get_descendants(to_uuid)
+            self.add_members(root_uuid, [u for u in new_member_uuids if u != root_uuid])
+            updated.append(root_uuid)
+
+        return updated
+
+    def get_descendants(self, node_uuid):
+        from lazy_node import LazyNode
+
+        node = LazyNode(self.data_proxy, node_uuid, fields=('outgoing',))
+        return list(node.query_outgoing())
+
+    def refresh(self):
+        '''
+        Rebuild the roots whose grid is half elapsed. Meant to be called periodically.
+
+        :returns: list of the roots rebuilt
+        '''
+
+        rebuilt = []
+        for root_uuid in self.roots(refresh=True):
+            start = self.redis.hget(self.data_proxy.get_aggregate_key(root_uuid), 'start')
+            if start is None or self.expired(float(start)):
+                try:
+                    self.rebuild(root_uuid)
+                except Exception:
+                    # TODO: Setup a proper log sink
+                    traceback.print_exc()
+                    continue
+                rebuilt.append(root_uuid)
+
+        return rebuilt
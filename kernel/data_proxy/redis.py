@@ -1,8 +1,20 @@
+import re
 import json
 import time
+import heapq
+import struct
+import hashlib
+import operator
 import traceback
 import datetime as dt
 from uuid import uuid4
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from redis.exceptions import ResponseError, WatchError
+
+from .scripts import CREATE_POINT
 
 
 class PointNotFoundError(Exception):
@@ -21,64 +33,691 @@ class NodeSaveError(Exception):
     pass
 
 
+class NodeConflictError(NodeSaveError):
+    pass
+
+
 class NodeSerializationError(Exception):
     pass
 
 
+class NodeIndexError(Exception):
+    pass
+
+
+class NodeLoadTimeoutError(Exception):
+    pass
+
+
+def normalize_index_value(value):
+    '''
+    Map values Python compares as equal, such as 1, 1.0 and True, to one JSON encoding
+    '''
+
+    if isinstance(value, (bool, int, float)):
+        if isinstance(value, float) and not value.is_integer():
+            return value
+        return int(value)
+
+    if isinstance(value, (list, tuple)):
+        return [normalize_index_value(v) for v in value]
+
+    if isinstance(value, dict):
+        return dict((k, normalize_index_value(v)) for k, v in value.items())
+
+    return value
+
+
 class BaseDataProxy():
     PointNotFoundError = PointNotFoundError
     PointSaveError = PointSaveError
     NodeNotFoundError = NodeNotFoundError
     NodeSaveError = NodeSaveError
+    NodeConflictError = NodeConflictError
     NodeSerializationError = NodeSerializationError
+    NodeIndexError = NodeIndexError
+    NodeLoadTimeoutError = NodeLoadTimeoutError
+
+    # The projectable parts of a node definition
+    NODE_FIELDS = ('synthesis', 'outgoing', 'incoming', 'attributes')
+
+    # Attribute index kinds: equality, and numeric ranges
+    INDEX_KINDS = ('eq', 'range')
+
+    # Predicates are (attribute, op, value) tuples
+    PREDICATE_OPS = {
+        '==': operator.eq,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge
+    }
+
+    # Wide reads by load_nodes_fanout(): nodes per chunk, chunks in flight per call, and threads
+    # shared by all calls
+    FANOUT_CHUNK_SIZE = 250
+    FANOUT_CONCURRENCY = 4
+    FANOUT_WORKERS = 16
 
     def __init__(self, *args, **kwargs):
-        pass
+        self.delta_listeners = []
+
+        # Optional ReachabilityCache, consulted by Node.query_outgoing
+        self.reach_cache = None
+
+        # Optional NodeFilter, answering for nodes that definitely don't exist without a read
+        self.node_filter = None
+
+        self.fanout_executor = None
+
+    def might_exist(self, node_uuid, exact=True):
+        '''
+        :param exact: If False, a node filter may answer from its replica without catching up,
+            for callers that recover from a node created meanwhile (see NodeFilter.get_missing)
+        :returns: False only if the node doesn't exist, True without a node filter
+        '''
+
+        return self.node_filter is None or self.node_filter.might_exist(node_uuid, exact=exact)
+
+    def add_delta_listener(self, callback):
+        '''
+        Register a callback invoked as callback(action, **kwargs) after each delta is written
+        '''
+
+        self.delta_listeners.append(callback)
+
+    def notify_delta(self, action, **kwargs):
+        for callback in self.delta_listeners:
+            try:
+                callback(action, **kwargs)
+            except Exception:
+                # A listener failing must not fail the write that already happened
+                # TODO: Setup a proper log sink
+                traceback.print_exc()
+
+    def match_predicates(self, attributes, predicates):
+        '''
+        Evaluate predicates against a dict of attributes. Missing attributes never match.
+        '''
+
+        for attr, op, value in predicates:
+            if attr not in attributes:
+                return False
+
+            try:
+                if not self.PREDICATE_OPS[op](attributes[attr], value):
+                    return False
+            except TypeError:
+                return False
+
+        return True
+
+    def load_nodes_fanout(self, node_uuids, fields=None, attrs=None, strict=False,
+                          chunk_size=None, concurrency=None, timeout=None):
+        '''
+        load_nodes() for very wide reads, such as the neighbours of a hub node. Rather than one
+        pipeline of thousands of reads, the uuids are split into chunks that are loaded
+        concurrently on a shared thread pool, each on its own pooled connection, so no single
+        server command runs long.
+
+        :param chunk_size: nodes per chunk, FANOUT_CHUNK_SIZE if None
+        :param concurrency: chunks in flight at once for this call, FANOUT_CONCURRENCY if None
+        :param timeout: seconds before giving up on the chunks still loading, None to wait
+        :returns: dict of node_uuid -> node definition (or None if missing)
+        :raises NodeLoadTimeoutError:
+                NodeNotFoundError: If strict
+                NodeSerializationError:
+        '''
+
+        chunk_size = chunk_size or self.FANOUT_CHUNK_SIZE
+        concurrency = concurrency or self.FANOUT_CONCURRENCY
+
+        chunks = deque(node_uuids[i:i + chunk_size] for i in range(0, len(node_uuids), chunk_size))
+        if len(chunks) <= 1:
+            return self.load_nodes(node_uuids, fields=fields, attrs=attrs, strict=strict)
+
+        if not self.fanout_executor:
+            self.fanout_executor = ThreadPoolExecutor(max_workers=self.FANOUT_WORKERS)
+
+        deadline = time.time() + timeout if timeout is not None else None
+
+        node_defs = {}
+        running = set()
+        try:
+            while chunks or running:
+                while chunks and len(running) < concurrency:
+                    running.add(self.fanout_executor.submit(self.load_nodes, chunks.popleft(),
+                                                            fields, attrs, strict))
+
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise self.NodeLoadTimeoutError('Timed out loading %d nodes' %
+                                                    len(node_uuids))
+
+                done, running = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node_defs.update(future.result())
+        finally:
+            # Chunks not yet started are dropped, the running ones finish unobserved
+            for future in running:
+                future.cancel()
+
+        return dict((node_uuid, node_defs[node_uuid]) for node_uuid in node_uuids)
+
+    def get_timeline(self, node_uuids, anchor_timestamp=None, window=None, limit=None):
+        '''
+        The points of many nodes as one stream, newest first, merged from the per-node histories.
+        Each node contributes at most limit points, as no more can make the cut.
+
+        :returns: list of (timestamp_epoch, node_uuid, point_uuid)
+        '''
+
+        histories = self.get_histories(node_uuids, anchor_timestamp=anchor_timestamp,
+                                       window=window, limit=limit)
+
+        streams = []
+        for node_uuid, history in histories.items():
+            streams.append(zip(history['timestamp_epoch'], [node_uuid] * len(history['uuid']),
+                               history['uuid']))
+
+        return list(islice(heapq.merge(*streams, reverse=True), limit))
 
 
 class RedisProxy(BaseDataProxy):
-    def __init__(self, redis):
+    # Nodes are stored as a hash, one field per NODE_FIELDS entry except attributes, which are
+    # stored one field per attribute under ATTR_PREFIX
+    ATTR_PREFIX = 'attr:'
+
+    NODE_UUID_RE = re.compile(r'^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}$', re.I)
+
+    # Seconds the cached index declarations are used before checking their version
+    INDEXES_TTL = 1.0
+
+    # Bloom filter of every node uuid, set on creation (see NodeFilter). 2^24 bits and 7 hashes
+    # keep false positives near 1% up to 1.7M nodes; changing either needs a rebuild.
+    NODE_FILTER_BITS = 2 ** 24
+    NODE_FILTER_HASHES = 7
+
+    # Creations kept in the filter log for replicas to catch up from
+    NODE_FILTER_LOG_LENGTH = 100000
+
+    def __init__(self, redis, hash_tags=False, max_shard_workers=8):
+        '''
+        :param redis: StrictRedis. Redis Cluster isn't supported, as the structures spanning nodes
+            are updated in transactions over several keys.
+        :param hash_tags: Wrap the uuid in node keys in a {hash tag}, so all of a node's keys map
+            to the same shard, see ShardedRedisProxy. Changes the key layout, so existing data must
+            be migrated.
+        :param max_shard_workers: Threads used to run per-shard bulk operations in parallel
+        '''
+
         super().__init__()
+
+        # The client for everything not owned by a single node (indexes, caches)
         self.redis = redis
+        self.hash_tags = hash_tags
+        self.max_shard_workers = max_shard_workers
+        self.shard_executor = None
+
+        # Mark nodes active in their client's NODE-SCORES-ACTIVE when publishing their signal, see
+        # score_recorder.track_activity()
+        self.score_activity = False
+
+        # attribute -> index kind, the version it was read at and when that was checked, see
+        # get_indexes()
+        self.indexes = None
+        self.indexes_version = None
+        self.indexes_checked = 0
+
+        self.create_point_script = self.redis.register_script(CREATE_POINT)
+
+    def get_client(self, node_uuid):
+        '''
+        The client holding the keys of a node
+        '''
+
+        return self.redis
+
+    def get_clients(self):
+        '''
+        Every distinct client, for operations that span all nodes
+        '''
+
+        return [self.redis]
+
+    def group_by_client(self, node_uuids):
+        '''
+        :returns: list of (client, node_uuids)
+        '''
+
+        groups = {}
+        for node_uuid in node_uuids:
+            client = self.get_client(node_uuid)
+            groups.setdefault(id(client), (client, []))[1].append(node_uuid)
+
+        return list(groups.values())
+
+    def map_clients(self, func, node_uuids):
+        '''
+        Call func(client, node_uuids) once per client holding any of the nodes, in parallel when
+        there's more than one
+
+        :returns: list of the func results
+        '''
+
+        groups = self.group_by_client(node_uuids)
+        if len(groups) <= 1:
+            return [func(client, uuids) for client, uuids in groups]
+
+        if not self.shard_executor:
+            self.shard_executor = ThreadPoolExecutor(max_workers=self.max_shard_workers)
+
+        futures = [self.shard_executor.submit(func, client, uuids) for client, uuids in groups]
+        return [f.result() for f in futures]
+
+    def tag(self, node_uuid):
+        if self.hash_tags:
+            return '{%s}' % node_uuid
+        return node_uuid
 
     def get_node_key(self, node_uuid):
-        return f'NODE-{node_uuid}'
+        return f'NODE-{self.tag(node_uuid)}'
 
     def get_node_stream_key(self, node_uuid):
-        return f'NODE-STREAM-{node_uuid}'
+        return f'NODE-STREAM-{self.tag(node_uuid)}'
 
     def get_node_signal_key(self, node_uuid):
-        return f'NODE-SIGNAL-{node_uuid}'
+        return f'NODE-SIGNAL-{self.tag(node_uuid)}'
 
     def get_node_points_key(self, node_uuid):
-        return f'NODE_POINTS-{node_uuid}'
+        return f'NODE_POINTS-{self.tag(node_uuid)}'
+
+    def get_reach_key(self, root_uuid):
+        return f'NODE-REACH-{root_uuid}'
+
+    def get_reach_versions_key(self):
+        return 'NODE-REACH-VERSIONS'
+
+    def get_reach_building_key(self):
+        return 'NODE-REACH-BUILDING'
+
+    def get_reach_pending_key(self, root_uuid):
+        return f'NODE-REACH-PENDING-{root_uuid}'
+
+    def get_node_snapshot_key(self, node_uuid):
+        return f'NODE-SNAPSHOT-{self.tag(node_uuid)}'
+
+    def get_score_series_key(self, node_uuid, step):
+        return f'NODE-SCORES-{self.tag(node_uuid)}-{step}'
+
+    def get_score_active_key(self):
+        return 'NODE-SCORES-ACTIVE'
+
+    def get_rescore_checkpoint_key(self, job_name):
+        return f'RESCORE-{job_name}'
+
+    def get_aggregate_key(self, root_uuid):
+        return f'NODE-AGG-{root_uuid}'
+
+    def get_aggregate_signal_key(self, root_uuid):
+        return f'NODE-AGG-SIGNAL-{root_uuid}'
+
+    def get_aggregate_roots_key(self):
+        return 'NODE-AGG-ROOTS'
+
+    def get_node_filter_key(self):
+        return 'NODE-FILTER'
+
+    def get_node_filter_log_key(self):
+        return 'NODE-FILTER-LOG'
+
+    def get_node_filter_params_key(self):
+        return 'NODE-FILTER-PARAMS'
+
+    def get_node_filter_params(self):
+        '''
+        :returns: the value of the params key once the filter is built with these parameters
+        '''
+
+        return f'{self.NODE_FILTER_BITS}:{self.NODE_FILTER_HASHES}'.encode()
+
+    def get_node_filter_offsets(self, node_uuid):
+        '''
+        The node's bits in the filter, by double hashing a single MD5
+        '''
+
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(node_uuid.encode()).digest())
+        return [(h1 + i * h2) % self.NODE_FILTER_BITS for i in range(self.NODE_FILTER_HASHES)]
+
+    def queue_node_filter_add(self, pipe, node_uuid):
+        '''
+        Add the commands setting a node's filter bits and logging its creation to a pipeline. The
+        bits are set first, so a replica reading the log never sees a creation ahead of its bits.
+        '''
+
+        for offset in self.get_node_filter_offsets(node_uuid):
+            pipe.setbit(self.get_node_filter_key(), offset, 1)
+        pipe.xadd(self.get_node_filter_log_key(), {'uuid': node_uuid},
+                  maxlen=self.NODE_FILTER_LOG_LENGTH, approximate=True)
+
+    def get_indexes_key(self):
+        return 'NODE-INDEXES'
+
+    def get_indexes_version_key(self):
+        return 'NODE-INDEXES-VERSION'
+
+    def get_eq_index_key(self, attr, value):
+        value = json.dumps(normalize_index_value(value), sort_keys=True)
+        return f'NODE-INDEX-EQ-{attr}-{value}'
+
+    def get_range_index_key(self, attr):
+        return f'NODE-INDEX-RANGE-{attr}'
+
+    def parse_node_key(self, key_func, key):
+        '''
+        The reverse of a key builder
+
+        :param key_func: key builder, e.g. get_node_stream_key
+        :returns: node_uuid, or None if the key wasn't built by key_func
+        '''
+
+        if type(key) is bytes:
+            key = key.decode()
+
+        prefix, suffix = key_func('\x00').split('\x00')
+        if key.startswith(prefix) and key.endswith(suffix):
+            return key[len(prefix):len(key) - len(suffix)]
+
+    def scan_node_keys(self, key_func, count=1000):
+        '''
+        Iterate over the keys of one kind present on every client
+
+        :param key_func: key builder, e.g. get_node_stream_key
+        :param count: SCAN batch size hint
+        :returns: generator of (node_uuid, key)
+        '''
+
+        for client in self.get_clients():
+            for key in client.scan_iter(match=key_func('*'), count=count):
+                node_uuid = self.parse_node_key(key_func, key)
+                if node_uuid is not None:
+                    yield node_uuid, key.decode() if type(key) is bytes else key
+
+    def scan_node_uuids(self, count=1000):
+        '''
+        Iterate over the uuids of the nodes present in redis
+
+        :param count: SCAN batch size hint
+        :returns: generator of node_uuid
+        '''
+
+        for node_uuid, _ in self.scan_node_keys(self.get_node_key, count=count):
+            # Without hash tags the node key pattern also matches the other NODE-* keys
+            if self.NODE_UUID_RE.match(node_uuid):
+                yield node_uuid
+
+    def scan_node_streams(self, count=1000):
+        '''
+        Iterate over the node streams present in redis
+
+        :param count: SCAN batch size hint
+        :returns: generator of (node_uuid, stream_key)
+        '''
+
+        return self.scan_node_keys(self.get_node_stream_key, count=count)
+
+    def encode_node(self, node_def):
+        '''
+        Flatten a serialized node into the fields of its redis hash. Each attribute gets its own
+        field so that single attributes can be fetched without the rest.
+        '''
+
+        mapping = {'uuid': node_def['uuid']}
+        for field in ('synthesis', 'outgoing', 'incoming'):
+            mapping[field] = json.dumps(node_def[field])
+
+        for key, value in node_def['attributes'].items():
+            mapping[self.ATTR_PREFIX + key] = json.dumps(value)
+
+        return mapping
+
+    def decode_node(self, node_uuid, mapping, full=True):
+        '''
+        The reverse of encode_node(). Fields missing from the mapping are omitted, unless this is
+        a full load.
+
+        :raises NodeSerializationError:
+        '''
+
+        node_def = {'uuid': node_uuid}
+        attributes = {}
+
+        for field, value in mapping.items():
+            if type(field) is bytes:
+                field = field.decode()
+
+            if value is None or field == 'uuid':
+                continue
+
+            try:
+                decoded = json.loads(value)
+            except Exception as e:
+                # TODO: Setup a proper log sink
+                traceback.print_exc()
+                raise self.NodeSerializationError('Node load failed: %s' % e)
+
+            if field.startswith(self.ATTR_PREFIX):
+                attributes[field[len(self.ATTR_PREFIX):]] = decoded
+            else:
+                node_def[field] = decoded
+
+        node_def['attributes'] = attributes
+        node_def.setdefault('version', 0)
+
+        if full:
+            node_def.setdefault('synthesis', None)
+            node_def.setdefault('outgoing', [])
+            node_def.setdefault('incoming', [])
+
+        return node_def
+
+    def queue_node_read(self, pipe, node_uuid, fields=None, attrs=None):
+        '''
+        Add the command loading a node, or a projection of it, to a pipeline
+
+        :param fields: node fields to load (see NODE_FIELDS), None for all
+        :param attrs: attribute names to load when 'attributes' isn't among the fields
+        :returns: the hash field names requested, or None for a full load
+        '''
 
-    def load_node(self, node_uuid):
         node_key = self.get_node_key(node_uuid)
 
-        if not self.redis.exists(node_key):
-            raise self.NodeNotFoundError('Node not found: %s' % node_uuid)
+        if fields is None or 'attributes' in fields:
+            pipe.hgetall(node_key)
+            return None
+
+        # 'uuid' is always present so it doubles as the existence check, and the version is always
+        # loaded so that a projected node can still be saved
+        field_names = ['uuid', 'version'] + [f for f in fields if f not in ('uuid', 'version')]
+        field_names += [self.ATTR_PREFIX + a for a in (attrs or [])]
+        pipe.hmget(node_key, field_names)
+        return field_names
+
+    def parse_node_read(self, node_uuid, field_names, result):
+        '''
+        :returns: node definition, or None if the node doesn't exist
+        '''
+
+        if field_names is None:
+            if not result:
+                return None
+            return self.decode_node(node_uuid, result, full=True)
+
+        if result[0] is None:
+            return None
+        return self.decode_node(node_uuid, dict(zip(field_names, result)), full=False)
 
-        node_json = self.redis.get(node_key)
+    def load_legacy_node(self, node_uuid):
+        '''
+        Nodes saved before the hash layout are a single JSON string. They are converted on their
+        next save.
+        '''
+
+        node_json = self.get_client(node_uuid).get(self.get_node_key(node_uuid))
+        if node_json is None:
+            return None
 
         try:
             node_def = json.loads(node_json)
+            node_def.setdefault('version', 0)
+            return node_def
         except Exception as e:
             # TODO: Setup a proper log sink
             traceback.print_exc()
             raise self.NodeSerializationError('Node load failed: %s' % e)
 
-        return node_def
+    def load_node(self, node_uuid, fields=None, attrs=None, use_filter=True):
+        '''
+        Load a node definition in a single round trip
+
+        :param fields: node fields to load (see NODE_FIELDS), None for all
+        :param attrs: attribute names to load when 'attributes' isn't among the fields
+        :param use_filter: See load_nodes()
+        :returns: dict
+        :raises NodeNotFoundError:
+                NodeSerializationError:
+        '''
+
+        return self.load_nodes([node_uuid], fields=fields, attrs=attrs, strict=True,
+                               use_filter=use_filter)[node_uuid]
+
+    def load_nodes(self, node_uuids, fields=None, attrs=None, strict=False, use_filter=True):
+        '''
+        Load many node definitions, or projections of them, in one pipelined round trip per
+        client
+
+        Nodes the node filter, if any, rules out are answered as missing without being read.
+
+        :param strict: If True, raise NodeNotFoundError for missing nodes rather than returning None
+        :param use_filter: If False, read every node even with a node filter, e.g. when it's known
+            to exist
+        :returns: dict of node_uuid -> node definition (or None if missing)
+        :raises NodeNotFoundError:
+                NodeSerializationError:
+        '''
+
+        def load(client, node_uuids):
+            pipe = client.pipeline(transaction=False)
+            reads = []
+            for node_uuid in node_uuids:
+                reads.append((node_uuid, self.queue_node_read(pipe, node_uuid, fields, attrs)))
+
+            return list(zip(reads, pipe.execute(raise_on_error=False)))
+
+        node_defs = {}
+        if self.node_filter and use_filter:
+            for node_uuid in self.node_filter.get_missing(node_uuids):
+                if strict:
+                    raise self.NodeNotFoundError('Node not found: %s' % node_uuid)
+                node_defs[node_uuid] = None
+
+        to_load = [u for u in node_uuids if u not in node_defs]
+        for client_results in self.map_clients(load, to_load):
+            for (node_uuid, field_names), result in client_results:
+                if isinstance(result, ResponseError):
+                    if 'WRONGTYPE' not in str(result):
+                        raise self.NodeSerializationError('Node load failed: %s' % result)
+                    node_def = self.load_legacy_node(node_uuid)
+                else:
+                    node_def = self.parse_node_read(node_uuid, field_names, result)
+
+                if node_def is None and strict:
+                    raise self.NodeNotFoundError('Node not found: %s' % node_uuid)
+
+                node_defs[node_uuid] = node_def
+
+        return dict((node_uuid, node_defs[node_uuid]) for node_uuid in node_uuids)
+
+    def get_node_version(self, client, node_key):
+        '''
+        :returns: the stored version, 0 for nodes saved before versioning, None if absent
+        '''
+
+        key_type = client.type(node_key)
+        if key_type == b'none':
+            return None
+        if key_type == b'string':
+            return 0
+
+        version = client.hget(node_key, 'version')
+        return int(version) if version is not None else 0
+
+    def save_node(self, node, force=False):
+        '''
+        Compare-and-set the node record. The save only succeeds if the stored version is still the
+        one the node was loaded at, or, for a node that was never loaded, if it doesn't exist yet.
+        The version is then incremented and set on the node.
+
+        :param force: Overwrite whatever is stored
+        :returns: node
+        :raises NodeConflictError: The node was created or changed by another writer
+                NodeSaveError:
+        '''
 
-    def save_node(self, node):
         node_def = node.serialize()
         node_key = self.get_node_key(node.uuid)
+        expected_version = getattr(node, 'version', None)
 
         try:
-            node_json = json.dumps(node_def)
-            result = self.redis.set(node_key, node_json)
-            if not result:
-                raise self.NodeSaveError(f'Redis error during node save: {result}')
+            mapping = self.encode_node(node_def)
+            indexes = self.get_indexes()
+
+            client = self.get_client(node.uuid)
+            with client.pipeline(transaction=True) as pipe:
+                # Any write to the node between here and execute() aborts the transaction
+                pipe.watch(node_key)
+
+                stored_version = self.get_node_version(pipe, node_key)
+                if not force and stored_version != expected_version:
+                    raise self.NodeConflictError('Node %s is at version %s, expected %s' % (
+                        node.uuid, stored_version, expected_version))
+
+                version = (stored_version or 0) + 1
+                mapping['version'] = version
+
+                created = stored_version is None
+
+                old_values = {}
+                if indexes:
+                    old_values = self.read_indexed_attributes(node.uuid, indexes)
+
+                # Replace the whole hash so removed attributes don't linger
+                pipe.multi()
+                pipe.delete(node_key)
+                pipe.hset(node_key, mapping=mapping)
+
+                # Indexes and the node filter live with the global structures. They join the
+                # node's transaction only when that's on the same instance.
+                global_pipe = pipe
+                if (indexes or created) and client is not self.redis:
+                    global_pipe = self.redis.pipeline(transaction=False)
+                self.queue_index_updates(global_pipe, node.uuid, indexes, old_values,
+                                         node_def['attributes'])
+                if created:
+                    self.queue_node_filter_add(global_pipe, node.uuid)
+
+                result = pipe.execute()
+                if not result[1]:
+                    raise self.NodeSaveError(f'Redis error during node save: {result}')
+
+            if global_pipe is not pipe:
+                global_pipe.execute()
+
+            # Visible to this process at once, others catch up from the log
+            if created and self.node_filter:
+                self.node_filter.add(node.uuid)
+        except WatchError:
+            raise self.NodeConflictError('Node %s was changed during save' % node.uuid)
         except self.NodeSaveError:
             raise
         except Exception as e:
@@ -86,17 +725,223 @@ class RedisProxy(BaseDataProxy):
             traceback.print_exc()
             raise self.NodeSaveError(f'Node save failed: {e}')
 
+        node.version = version
         return node
 
+    def get_indexes(self, refresh=False):
+        '''
+        The declared attribute indexes, cached in-process. The cache is used for up to
+        INDEXES_TTL seconds, then NODE-INDEXES-VERSION is checked and the declarations only read
+        again if it moved.
+
+        :returns: dict of attribute -> index kind
+        '''
+
+        now = time.time()
+        fresh = now - self.indexes_checked < self.INDEXES_TTL
+        if self.indexes is not None and fresh and not refresh:
+            return self.indexes
+
+        version = self.redis.get(self.get_indexes_version_key())
+        if self.indexes is None or refresh or version != self.indexes_version:
+            declared = self.redis.hgetall(self.get_indexes_key())
+            self.indexes = dict((k.decode(), v.decode()) for k, v in declared.items())
+            self.indexes_version = version
+
+        self.indexes_checked = now
+        return self.indexes
+
+    def declare_index(self, attr, kind='eq', build=True):
+        '''
+        Declare an attribute index, maintained on every node save from now on. Other processes
+        pick up the declaration within INDEXES_TTL, so the build waits that long before scanning,
+        leaving no save unindexed.
+
+        :param kind: 'eq' for equality lookups (a set per value), 'range' for numeric comparisons
+            (one zset scored by the value)
+        :param build: If True, index the existing nodes now
+        :returns: number of nodes indexed
+        :raises NodeIndexError: Unknown kind
+        '''
+
+        if kind not in self.INDEX_KINDS:
+            raise self.NodeIndexError(f'Unknown index kind: {kind}')
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self.get_indexes_key(), attr, kind)
+        pipe.incr(self.get_indexes_version_key())
+        pipe.execute()
+        self.get_indexes(refresh=True)
+
+        if not build:
+            return 0
+
+        time.sleep(self.INDEXES_TTL)
+
+        num_indexed = 0
+        batch = []
+        for node_uuid in self.scan_node_uuids():
+            batch.append(node_uuid)
+            if len(batch) >= 1000:
+                num_indexed += self.build_index(attr, batch)
+                batch = []
+
+        if batch:
+            num_indexed += self.build_index(attr, batch)
+
+        return num_indexed
+
+    def build_index(self, attr, node_uuids):
+        kind = self.get_indexes()[attr]
+        node_defs = self.load_nodes(node_uuids, fields=[], attrs=[attr], use_filter=False)
+
+        num_indexed = 0
+        pipe = self.redis.pipeline(transaction=False)
+        for node_uuid, node_def in node_defs.items():
+            if node_def is None or attr not in node_def['attributes']:
+                continue
+
+            self.queue_index_updates(pipe, node_uuid, {attr: kind}, {}, node_def['attributes'])
+            num_indexed += 1
+
+        pipe.execute()
+        return num_indexed
+
+    def read_indexed_attributes(self, node_uuid, indexes):
+        '''
+        The currently stored values of the indexed attributes, needed to remove stale entries
+
+        :returns: dict of attribute -> value, for the attributes that are set
+        '''
+
+        # Bypasses the node filter, a creation it hasn't seen yet would leave stale entries
+        node_def = self.load_nodes([node_uuid], fields=[], attrs=list(indexes),
+                                   use_filter=False)[node_uuid]
+        if node_def is None:
+            return {}
+
+        return dict((k, v) for k, v in node_def['attributes'].items() if k in indexes)
+
+    def is_range_value(self, value):
+        # Booleans included, as they compare as 0 and 1
+        return isinstance(value, (int, float))
+
+    def queue_index_updates(self, pipe, node_uuid, indexes, old_values, attributes):
+        for attr, kind in indexes.items():
+            new_value = attributes.get(attr)
+            old_value = old_values.get(attr)
+
+            if kind == 'eq':
+                if attr in old_values and (attr not in attributes or old_value != new_value):
+                    pipe.srem(self.get_eq_index_key(attr, old_value), node_uuid)
+                if attr in attributes:
+                    pipe.sadd(self.get_eq_index_key(attr, new_value), node_uuid)
+
+            elif kind == 'range':
+                range_key = self.get_range_index_key(attr)
+                if attr in attributes and self.is_range_value(new_value):
+                    pipe.zadd(range_key, {node_uuid: float(new_value)})
+                elif attr in old_values:
+                    pipe.zrem(range_key, node_uuid)
+
+    def find_nodes(self, attr, value=None, min_value=None, max_value=None):
+        '''
+        Look up nodes directly from an index, without touching the node records
+
+        :param value: equality lookup, requires an 'eq' index
+        :param min_value, max_value: inclusive bounds, requires a 'range' index
+        :returns: set of node_uuids
+        :raises NodeIndexError: The attribute doesn't have the required index
+        '''
+
+        kind = self.get_indexes().get(attr)
+
+        if min_value is None and max_value is None:
+            if kind != 'eq':
+                raise self.NodeIndexError(f'No eq index on {attr}')
+            members = self.redis.smembers(self.get_eq_index_key(attr, value))
+        else:
+            if kind != 'range':
+                raise self.NodeIndexError(f'No range index on {attr}')
+            members = self.redis.zrangebyscore(self.get_range_index_key(attr),
+                                               '-inf' if min_value is None else min_value,
+                                               '+inf' if max_value is None else max_value)
+
+        return set(m.decode() for m in members)
+
+    def filter_nodes(self, node_uuids, predicates):
+        '''
+        Select the nodes matching every predicate without loading them. Predicates on indexed
+        attributes are answered from the indexes in one pipeline. Any others are answered from a
+        projected load of just those attributes, for the nodes still remaining.
+
+        :param predicates: list of (attribute, op, value), op one of PREDICATE_OPS
+        :returns: list of matching node_uuids, in the given order
+        '''
+
+        node_uuids = list(node_uuids)
+        if not node_uuids or not predicates:
+            return node_uuids
+
+        indexes = self.get_indexes()
+
+        indexed = []
+        unindexed = []
+        for attr, op, value in predicates:
+            if op not in self.PREDICATE_OPS:
+                raise self.NodeIndexError(f'Unknown predicate op: {op}')
+
+            # A range index only holds numbers, so it can't answer for any other value
+            kind = indexes.get(attr)
+            if (kind == 'range' and self.is_range_value(value)) or (kind == 'eq' and op == '=='):
+                indexed.append((attr, op, value, kind))
+            else:
+                unindexed.append((attr, op, value))
+
+        if indexed:
+            pipe = self.redis.pipeline(transaction=False)
+            for node_uuid in node_uuids:
+                for attr, op, value, kind in indexed:
+                    if kind == 'eq':
+                        pipe.sismember(self.get_eq_index_key(attr, value), node_uuid)
+                    else:
+                        pipe.zscore(self.get_range_index_key(attr), node_uuid)
+            results = iter(pipe.execute())
+
+            matching = []
+            for node_uuid in node_uuids:
+                matched = True
+                for attr, op, value, kind in indexed:
+                    result = next(results)
+                    if kind == 'eq':
+                        matched = matched and bool(result)
+                    else:
+                        matched = matched and result is not None and \
+                            self.PREDICATE_OPS[op](result, value)
+                if matched:
+                    matching.append(node_uuid)
+
+            node_uuids = matching
+
+        if unindexed and node_uuids:
+            attrs = list(set(attr for attr, _, _ in unindexed))
+            node_defs = self.load_nodes(node_uuids, fields=[], attrs=attrs)
+            node_uuids = [u for u in node_uuids if node_defs[u] is not None and
+                          self.match_predicates(node_defs[u]['attributes'], unindexed)]
+
+        return node_uuids
+
     def delta(self, action, **kwargs):
         # Add to stream directly or else exec callback / trigger event
+        client = self.get_client(kwargs['node_uuid'])
+
         if action in ('AddPoint', 'UpdatePoint'):
             node_uuid = kwargs['node_uuid']
             point_uuid = kwargs['point_uuid']
             timestamp = kwargs['timestamp']
 
             stream_key = self.get_node_stream_key(node_uuid)
-            self.redis.xadd(stream_key, {
+            client.xadd(stream_key, {
                 'action': action,
                 'point_uuid': point_uuid,
                 'timestamp': timestamp
@@ -109,7 +954,11 @@ class RedisProxy(BaseDataProxy):
             signal_key = self.get_node_signal_key(node_uuid)
             keyval = {}
             keyval['wave_func'] = json.dumps(wave_func)
-            self.redis.xadd(signal_key, keyval, maxlen=1, approximate=False)
+
+            pipe = client.pipeline(transaction=False)
+            pipe.xadd(signal_key, keyval, maxlen=1, approximate=False)
+            self.queue_score_activity(pipe, [node_uuid])
+            pipe.execute()
 
         elif action == 'AddOutgoingConnection':
             node_uuid = kwargs['node_uuid']
@@ -117,7 +966,7 @@ class RedisProxy(BaseDataProxy):
             timestamp = time.time()
 
             stream_key = self.get_node_stream_key(node_uuid)
-            self.redis.xadd(stream_key, {
+            client.xadd(stream_key, {
                 'action': action,
                 'outgoing_node_uuid': outgoing_node_uuid,
                 'timestamp': timestamp
@@ -129,7 +978,7 @@ class RedisProxy(BaseDataProxy):
             timestamp = time.time()
 
             stream_key = self.get_node_stream_key(node_uuid)
-            self.redis.xadd(stream_key, {
+            client.xadd(stream_key, {
                 'action': action,
                 'incoming_node_uuid': incoming_node_uuid,
                 'timestamp': timestamp
@@ -138,10 +987,83 @@ class RedisProxy(BaseDataProxy):
         else:
             raise NotImplementedError('Delta not implemented for %s' % action)
 
-    def get_node_history(self, node,
-                         anchor_timestamp=None,
-                         window=None,
-                         limit=None):
+        self.notify_delta(action, **kwargs)
+
+    def get_signal(self, node_uuid):
+        '''
+        The latest published NodeSignal
+
+        :returns: wave_func serialized as dict, or None
+        '''
+
+        return self.get_signals([node_uuid])[node_uuid]
+
+    def get_signals(self, node_uuids):
+        '''
+        The latest published NodeSignal of many nodes in one pipelined round trip per client
+
+        :returns: dict of node_uuid -> wave_func serialized as dict, or None
+        '''
+
+        def load(client, node_uuids):
+            pipe = client.pipeline(transaction=False)
+            for node_uuid in node_uuids:
+                pipe.xrevrange(self.get_node_signal_key(node_uuid), max='+', min='-', count=1)
+            return list(zip(node_uuids, pipe.execute()))
+
+        signals = {}
+        for client_results in self.map_clients(load, node_uuids):
+            for node_uuid, result in client_results:
+                signals[node_uuid] = json.loads(result[0][1][b'wave_func']) if result else None
+
+        return signals
+
+    def publish_signals(self, signals):
+        '''
+        Publish many NodeSignals, one pipelined round trip per client
+
+        :param signals: dict of node_uuid -> wave_func serialized as dict, or None to remove the
+            node's signal, e.g. once it no longer scores
+        :returns: None
+        '''
+
+        def publish(client, node_uuids):
+            pipe = client.pipeline(transaction=False)
+            for node_uuid in node_uuids:
+                signal_key = self.get_node_signal_key(node_uuid)
+                if signals[node_uuid] is None:
+                    pipe.delete(signal_key)
+                else:
+                    pipe.xadd(signal_key, {'wave_func': json.dumps(signals[node_uuid])},
+                              maxlen=1, approximate=False)
+            self.queue_score_activity(pipe, [u for u in node_uuids if signals[u] is not None])
+            pipe.execute()
+
+        self.map_clients(publish, list(signals))
+
+        for node_uuid, wave_func in signals.items():
+            self.notify_delta('NodeSignal', node_uuid=node_uuid, wave_func=wave_func)
+
+    def queue_score_activity(self, pipe, node_uuids, timestamp=None):
+        '''
+        Add marking nodes active to a pipeline on their client, if activity is tracked
+        '''
+
+        if self.score_activity and node_uuids:
+            if timestamp is None:
+                timestamp = time.time()
+            pipe.zadd(self.get_score_active_key(), dict((u, timestamp) for u in node_uuids))
+
+    def get_histories(self, node_uuids, anchor_timestamp=None, window=None, limit=None):
+        '''
+        The points of many nodes in one pipelined round trip per client
+
+        :param anchor_timestamp: newest possible point, defaults to now
+        :param window: range in seconds, None for all
+        :param limit: maximum number of points per node
+        :returns: dict of node_uuid -> {'uuid': [point_uuid], 'timestamp_epoch': [timestamp]},
+            newest first
+        '''
 
         if not anchor_timestamp:
             anchor_timestamp = time.time()
@@ -150,12 +1072,34 @@ class RedisProxy(BaseDataProxy):
         if window:
             past_timestamp = anchor_timestamp - window
 
-        node_points_key = self.get_node_points_key(node.uuid)
-        query_result = self.redis.zrevrangebyscore(node_points_key, anchor_timestamp,
-                                                   past_timestamp, withscores=True)
+        def load(client, node_uuids):
+            pipe = client.pipeline(transaction=False)
+            for node_uuid in node_uuids:
+                pipe.zrevrangebyscore(self.get_node_points_key(node_uuid), anchor_timestamp,
+                                      past_timestamp, start=0 if limit else None, num=limit,
+                                      withscores=True)
+            return list(zip(node_uuids, pipe.execute()))
+
+        histories = {}
+        for client_results in self.map_clients(load, node_uuids):
+            for node_uuid, result in client_results:
+                histories[node_uuid] = {
+                    'uuid': [point_uuid for point_uuid, _ in result],
+                    'timestamp_epoch': [point_timestamp for _, point_timestamp in result]
+                }
+
+        return dict((node_uuid, histories[node_uuid]) for node_uuid in node_uuids)
+
+    def get_node_history(self, node,
+                         anchor_timestamp=None,
+                         window=None,
+                         limit=None):
+
+        history = self.get_histories([node.uuid], anchor_timestamp=anchor_timestamp,
+                                     window=window, limit=limit)[node.uuid]
 
         result = []
-        for point_uuid, point_timestamp in query_result:
+        for point_uuid, point_timestamp in zip(history['uuid'], history['timestamp_epoch']):
             result.append({
                 'uuid': point_uuid,
                 'timestamp_epoch': point_timestamp,
@@ -167,18 +1111,108 @@ class RedisProxy(BaseDataProxy):
     def create_point(self, node, timestamp):
         point_uuid = str(uuid4())
         node_points_key = self.get_node_points_key(node.uuid)
-        result = self.redis.zadd(node_points_key, dict([(point_uuid, timestamp)]))
+        result = self.get_client(node.uuid).zadd(node_points_key, dict([(point_uuid, timestamp)]))
         if result != 1:
             raise self.PointSaveError('Failed to add point to node via redis')
 
         self.delta('AddPoint', node_uuid=node.uuid, point_uuid=point_uuid, timestamp=timestamp)
         return point_uuid
 
+    def create_points(self, node, timestamps):
+        '''
+        Insert many points and their AddPoint deltas in one transaction
+
+        :returns: list of point_uuid, in the order of timestamps
+        :raises PointSaveError:
+        '''
+
+        point_uuids = [str(uuid4()) for _ in timestamps]
+        stream_key = self.get_node_stream_key(node.uuid)
+
+        try:
+            pipe = self.get_client(node.uuid).pipeline(transaction=True)
+            pipe.zadd(self.get_node_points_key(node.uuid), dict(zip(point_uuids, timestamps)))
+            for point_uuid, timestamp in zip(point_uuids, timestamps):
+                pipe.xadd(stream_key, {
+                    'action': 'AddPoint',
+                    'point_uuid': point_uuid,
+                    'timestamp': timestamp
+                })
+            pipe.execute()
+        except Exception as e:
+            # TODO: Setup a proper log sink
+            traceback.print_exc()
+            raise self.PointSaveError(f'Point save failed: {e}')
+
+        for point_uuid, timestamp in zip(point_uuids, timestamps):
+            self.notify_delta('AddPoint', node_uuid=node.uuid, point_uuid=point_uuid,
+                              timestamp=timestamp)
+
+        return point_uuids
+
+    def create_point_with_signal(self, node, timestamp, anchor_timestamp, window, decay,
+                                 num_points):
+        '''
+        Insert a point, emit its AddPoint delta and publish the recomputed NodeSignal in a single
+        atomic server-side call, so concurrent writers never publish a signal computed from stale
+        history.
+
+        :returns: (point_uuid, wave_func serialized as dict, or None if the history is too short)
+        :raises PointSaveError:
+        '''
+
+        point_uuids, wave_func = self.create_points_with_signal(
+            node, [timestamp], anchor_timestamp, window, decay, num_points)
+
+        return point_uuids[0], wave_func
+
+    def create_points_with_signal(self, node, timestamps, anchor_timestamp, window, decay,
+                                  num_points):
+        '''
+        create_point_with_signal() for many points, e.g. a deferred batch: all of them and a
+        single recomputed NodeSignal in one atomic server-side call
+
+        :returns: (list of point_uuid in the order of timestamps, wave_func serialized as dict, or
+            None if the history is too short)
+        :raises PointSaveError:
+        '''
+
+        point_uuids = [str(uuid4()) for _ in timestamps]
+
+        args = [anchor_timestamp, window, decay, num_points, node.uuid]
+        for point_uuid, timestamp in zip(point_uuids, timestamps):
+            args.extend([point_uuid, repr(float(timestamp))])
+
+        keys = [self.get_node_points_key(node.uuid),
+                self.get_node_stream_key(node.uuid),
+                self.get_node_signal_key(node.uuid)]
+        if self.score_activity:
+            keys.append(self.get_score_active_key())
+
+        client = self.get_client(node.uuid)
+        try:
+            _, wave_func_json = self.create_point_script(keys=keys, args=args, client=client)
+        except Exception as e:
+            # TODO: Setup a proper log sink
+            traceback.print_exc()
+            raise self.PointSaveError(f'Point save failed: {e}')
+
+        for point_uuid, timestamp in zip(point_uuids, timestamps):
+            self.notify_delta('AddPoint', node_uuid=node.uuid, point_uuid=point_uuid,
+                              timestamp=timestamp)
+
+        wave_func = None
+        if wave_func_json:
+            wave_func = json.loads(wave_func_json)
+            self.notify_delta('NodeSignal', node_uuid=node.uuid, wave_func=wave_func)
+
+        return point_uuids, wave_func
+
     def get_point(self, node_uuid, point_uuid):
         node_points_key = self.get_node_points_key(node_uuid)
 
         try:
-            timestamp_epoch = self.redis.zscore(node_points_key, point_uuid)
+            timestamp_epoch = self.get_client(node_uuid).zscore(node_points_key, point_uuid)
             if not timestamp_epoch:
                 raise self.PointNotFoundError('Point not found')
         except self.PointNotFoundError:
@@ -195,7 +1229,7 @@ class RedisProxy(BaseDataProxy):
         timestamp = point.timestamp_epoch
 
         try:
-            self.redis.zadd(node_points_key, dict([(point.uuid, timestamp)]))
+            self.get_client(point.node_uuid).zadd(node_points_key, dict([(point.uuid, timestamp)]))
         except Exception as e:
             # TODO: Setup a proper log sink
             traceback.print_exc()
@@ -0,0 +1,155 @@
+'''
+Server-side Lua scripts used by RedisProxy. Registered once per client and invoked via EVALSHA,
+falling back to SCRIPT LOAD when the server doesn't have them cached.
+'''
+
+# Insert one or more points, emit their AddPoint deltas, and compute + publish the NodeSignal
+# atomically.
+#
+# Mirrors Node.get_period() / Node.get_score_func(): the newest num_points points within
+# [anchor - window, anchor] give the average interval (period), and the newest point is the
+# ref_time. Numbers are formatted with %.17g so they round-trip to the same doubles Python produces.
+#
+# KEYS[1]: node points zset
+# KEYS[2]: node stream
+# KEYS[3]: node signal stream
+# KEYS[4]: optional, the active nodes zset, where the node is scored by the anchor when a signal
+#          is published (see score_recorder.track_activity)
+# ARGV: anchor_timestamp, window, decay, num_points, node_uuid, then point_uuid, timestamp per
+#       point
+#
+# Returns {number of points, wave_func_json or nil}
+CREATE_POINT = '''
+local anchor = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local decay = tonumber(ARGV[3])
+local num_points = tonumber(ARGV[4])
+
+-- One ZADD per point, a batch can be larger than unpack() allows
+local num_added = 0
+for i = 6, #ARGV, 2 do
+    num_added = num_added + redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+end
+if num_added ~= (#ARGV - 5) / 2 then
+    return redis.error_reply('Failed to add point to node via redis')
+end
+
+for i = 6, #ARGV, 2 do
+    redis.call('XADD', KEYS[2], '*',
+               'action', 'AddPoint',
+               'point_uuid', ARGV[i],
+               'timestamp', ARGV[i + 1])
+end
+
+local min_score = '-inf'
+if window > 0 then
+    min_score = string.format('%.17g', anchor - window)
+end
+
+local pts = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[1], min_score,
+                       'WITHSCORES', 'LIMIT', 0, num_points)
+
+-- WITHSCORES interleaves member, score
+local times = {}
+for i = 2, #pts, 2 do
+    times[#times + 1] = tonumber(pts[i])
+end
+
+if #times < 2 or times[1] == 0 then
+    return {num_added, false}
+end
+
+local total = 0
+for i = 2, #times do
+    total = total + (times[i - 1] - times[i])
+end
+local period = total / (#times - 1)
+
+local time_since = anchor - times[1]
+local ref_time = anchor - time_since
+
+local wave_func = string.format(
+    '{"ref_time": %.17g, "period": %.17g, "decay": %.17g, ' ..
+    '"funcs": [{"func": "sin", "phase": 0}]}',
+    ref_time, period, decay)
+
+redis.call('XADD', KEYS[3], 'MAXLEN', 1, '*', 'wave_func', wave_func)
+
+if KEYS[4] then
+    redis.call('ZADD', KEYS[4], ARGV[1], ARGV[5])
+end
+
+return {num_added, wave_func}
+'''
+
+
+# Trim a stream to the entries from a given id onwards. XTRIM MINID isn't available before
+# redis 6.2, so the entries to keep are counted and trimmed to by MAXLEN, atomically.
+#
+# KEYS[1]: stream
+# ARGV[1]: first id to keep
+#
+# Returns the number of entries removed
+TRIM_STREAM_BEFORE = '''
+local length = redis.call('XLEN', KEYS[1])
+local keep = #redis.call('XRANGE', KEYS[1], ARGV[1], '+')
+redis.call('XTRIM', KEYS[1], 'MAXLEN', keep)
+return length - keep
+'''
+
+
+def verify_create_point(data_proxy, num_points=8, interval=300):
+    '''
+    Check that the create_point script publishes the same wave function definition as the Python
+    Node.get_score_func() for a scratch node. The scratch node's keys are removed afterwards.
+
+    :returns: list of (script_def, python_def) pairs that differ
+    '''
+
+    import math
+    import time
+    from uuid import uuid4
+
+    from node import Node
+
+    node = Node(data_proxy, uuid=str(uuid4()), load=False)
+    now = time.time()
+
+    mismatches = []
+    try:
+        for i in range(num_points):
+            # Uneven spacing so the averaging is exercised
+            timestamp = now - (num_points - i) * interval + (i * 7.123456)
+            anchor_timestamp = math.ceil(time.time())
+
+            _, script_def = data_proxy.create_point_with_signal(
+                node, timestamp,
+                anchor_timestamp=anchor_timestamp,
+                window=node.SCORE_WINDOW,
+                decay=node.SCORE_DECAY,
+                num_points=node.SCORE_INTERVAL_POINTS)
+
+            python_def = node.get_score_func(anchor_timestamp=anchor_timestamp, serialized=True)
+            if script_def != python_def:
+                mismatches.append((script_def, python_def))
+    finally:
+        data_proxy.get_client(node.uuid).delete(data_proxy.get_node_points_key(node.uuid),
+                                                data_proxy.get_node_stream_key(node.uuid),
+                                                data_proxy.get_node_signal_key(node.uuid))
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    import sys
+    from redis import StrictRedis
+    from data_proxy.redis import RedisProxy
+
+    host = sys.argv[1] if len(sys.argv) > 1 else 'redis'
+    mismatches = verify_create_point(RedisProxy(StrictRedis(host=host, db=0)))
+    for script_def, python_def in mismatches:
+        print('script', script_def)
+        print('python', python_def)
+
+    print('create_point script: %s' % ('MISMATCH' if mismatches else 'OK'))
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,70 @@
+import hashlib
+from bisect import bisect
+
+from .redis import RedisProxy
+
+
+class HashRing():
+    '''
+    Consistent hash ring with virtual nodes, so adding or removing a shard only moves the keys
+    adjacent to its points on the ring.
+
+    :param names: shard names
+    :param replicas: points per shard on the ring
+    '''
+
+    def __init__(self, names, replicas=160):
+        self.ring = []
+        for name in names:
+            for i in range(replicas):
+                self.ring.append((self.hash('%s:%d' % (name, i)), name))
+        self.ring.sort()
+        self.points = [point for point, _ in self.ring]
+
+    def hash(self, key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def get(self, key):
+        i = bisect(self.points, self.hash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+
+class ShardedRedisProxy(RedisProxy):
+    '''
+    A RedisProxy spread over several independent redis instances. Each node's keys are hash
+    tagged and routed together, by node uuid, to one shard on a consistent hash ring, so the
+    per-node transactions and scripts still run on a single instance. Bulk operations are grouped
+    per shard and the shards are run in parallel.
+
+    Structures that span nodes (attribute indexes, reachability and aggregate caches) live on the
+    global shard.
+
+    Redis Cluster isn't supported: the cross-node structures are updated in transactions over
+    several keys, which a cluster only allows within one slot.
+
+    :param shards: dict of shard name -> StrictRedis
+    :param global_shard: name of the shard for the cross-node structures, the first name sorted
+        if None
+    :param replicas: points per shard on the hash ring
+    '''
+
+    def __init__(self, shards, global_shard=None, replicas=160, max_shard_workers=None):
+        names = sorted(shards)
+        if global_shard is None:
+            global_shard = names[0]
+
+        super().__init__(shards[global_shard], hash_tags=True,
+                         max_shard_workers=max_shard_workers or len(names))
+
+        self.shards = shards
+        self.global_shard = global_shard
+        self.ring = HashRing(names, replicas=replicas)
+
+    def get_shard_name(self, node_uuid):
+        return self.ring.get(node_uuid)
+
+    def get_client(self, node_uuid):
+        return self.shards[self.ring.get(node_uuid)]
+
+    def get_clients(self):
+        return [self.shards[name] for name in sorted(self.shards)]
@@ -0,0 +1,361 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+
+from redis import StrictRedis
+
+from data_proxy.scripts import TRIM_STREAM_BEFORE
+
+
+class ReplayError(Exception):
+    pass
+
+
+def parse_stream_id(stream_id):
+    '''
+    :param stream_id: 'ms-seq' or 'ms' (bytes or str). A bare 'ms' sorts after every id in that
+        millisecond, matching how redis treats an incomplete range end.
+    :returns: (ms, seq) tuple for ordering
+    '''
+
+    if type(stream_id) is bytes:
+        stream_id = stream_id.decode()
+
+    if '-' in stream_id:
+        ms, seq = stream_id.split('-')
+        return int(ms), int(seq)
+
+    return int(stream_id), float('inf')
+
+
+def next_stream_id(stream_id):
+    ms, seq = parse_stream_id(stream_id)
+    return '%d-%d' % (ms, seq + 1)
+
+
+class EventStore():
+    '''
+    Snapshot-plus-log node state built on the NODE-STREAM-* deltas.
+
+    A snapshot is the node's state as of a given node stream id, appended to
+    NODE-SNAPSHOT-{uuid}. The last `keep` snapshots are retained, and the node stream is trimmed
+    behind the oldest of them. A node can then be rebuilt as of any point since that snapshot, from
+    the nearest snapshot plus the tail of the stream after it.
+
+    Connections are event sourced. Points are only counted, with the range of their timestamps,
+    so snapshots stay small however many points a node has; the points themselves stay in
+    NODE-POINTS-{uuid}. Attributes and synthesis have no deltas, so they are taken from the node
+    record at snapshot time.
+
+    A stream no consumer group reads yet isn't trimmed, as the signal workers create their group
+    from the start of the stream.
+
+    :param data_proxy: RedisProxy
+    :param keep: snapshots retained per node
+    '''
+
+    ReplayError = ReplayError
+
+    def __init__(self, data_proxy, keep=3):
+        self.data_proxy = data_proxy
+        self.keep = keep
+
+        self.trim_script = data_proxy.redis.register_script(TRIM_STREAM_BEFORE)
+
+    def empty_state(self, node_uuid):
+        return {
+            'uuid': node_uuid,
+            'synthesis': None,
+            'outgoing': [],
+            'incoming': [],
+            'attributes': {},
+            'num_points': 0,
+            'point_range': None
+        }
+
+    def apply(self, state, entries):
+        '''
+        Apply node stream entries to a state, in place
+
+        :returns: state
+        '''
+
+        for _, fields in entries:
+            if not fields:
+                continue
+
+            action = fields.get(b'action')
+            if action in (b'AddPoint', b'UpdatePoint'):
+                if action == b'AddPoint':
+                    state['num_points'] += 1
+
+                # Covers every timestamp a point has had, moved points can't shrink it
+                timestamp = float(fields[b'timestamp'])
+                point_range = state['point_range'] or [timestamp, timestamp]
+                state['point_range'] = [min(point_range[0], timestamp),
+                                        max(point_range[1], timestamp)]
+
+            elif action == b'AddOutgoingConnection':
+                outgoing_node_uuid = fields[b'outgoing_node_uuid'].decode()
+                if outgoing_node_uuid not in state['outgoing']:
+                    state['outgoing'].append(outgoing_node_uuid)
+
+            elif action == b'AddIncomingConnection':
+                incoming_node_uuid = fields[b'incoming_node_uuid'].decode()
+                if incoming_node_uuid not in state['incoming']:
+                    state['incoming'].append(incoming_node_uuid)
+
+        return state
+
+    def get_until_id(self, until):
+        '''
+        :param until: stream id, epoch timestamp, or None for the latest
+        :returns: stream id usable as a range end
+        '''
+
+        if until is None:
+            return '+'
+
+        if type(until) in (int, float):
+            return str(int(until * 1000))
+
+        return until
+
+    def select_snapshot(self, node_uuid, snapshots, until_id):
+        '''
+        The newest snapshot covering no more than until_id
+
+        :param snapshots: XREVRANGE result of the snapshot stream, newest first
+        :returns: (covered stream id, state) or (None, None) if replay starts from the beginning
+        :raises ReplayError: Every retained snapshot is newer than until_id, and the stream behind
+            them has been trimmed
+        '''
+
+        if not snapshots:
+            return None, None
+
+        for _, fields in snapshots:
+            stream_id = fields[b'stream_id'].decode()
+            if until_id == '+' or parse_stream_id(stream_id) <= parse_stream_id(until_id):
+                return stream_id, json.loads(fields[b'state'])
+
+        raise self.ReplayError('History before %s has been compacted for %s' % (
+            snapshots[-1][1][b'stream_id'].decode(), node_uuid))
+
+    def replay(self, node_uuid, until=None):
+        '''
+        Rebuild a node's state from its nearest snapshot and the stream tail after it
+
+        :param until: stream id or epoch timestamp for a point-in-time read, None for the latest
+        :returns: (state dict, last stream id applied or None)
+        :raises ReplayError:
+        '''
+
+        return self.replay_nodes([node_uuid], until=until)[node_uuid]
+
+    def replay_nodes(self, node_uuids, until=None):
+        '''
+        replay() for many nodes, two pipelined round trips in total
+
+        :returns: dict of node_uuid -> (state dict, last stream id applied or None)
+        :raises ReplayError:
+        '''
+
+        until_id = self.get_until_id(until)
+
+        def load(client, node_uuids):
+            pipe = client.pipeline(transaction=False)
+            for node_uuid in node_uuids:
+                pipe.xrevrange(self.data_proxy.get_node_snapshot_key(node_uuid), max='+',
+                               min='-', count=self.keep)
+            all_snapshots = pipe.execute()
+
+            starts = []
+            pipe = client.pipeline(transaction=False)
+            for node_uuid, snapshots in zip(node_uuids, all_snapshots):
+                stream_id, state = self.select_snapshot(node_uuid, snapshots, until_id)
+                starts.append((node_uuid, stream_id, state or self.empty_state(node_uuid)))
+
+                min_id = next_stream_id(stream_id) if stream_id else '-'
+                pipe.xrange(self.data_proxy.get_node_stream_key(node_uuid), min=min_id,
+                            max=until_id)
+
+            return list(zip(starts, pipe.execute()))
+
+        result = {}
+        for client_results in self.data_proxy.map_clients(load, node_uuids):
+            for (node_uuid, stream_id, state), entries in client_results:
+                self.apply(state, entries)
+                if entries:
+                    stream_id = entries[-1][0].decode()
+                result[node_uuid] = (state, stream_id)
+
+        return result
+
+    def snapshot(self, node_uuid):
+        '''
+        Append a snapshot of the node as of its latest stream entry, then compact the stream
+
+        :returns: covered stream id, or None if there was nothing new to snapshot
+        '''
+
+        client = self.data_proxy.get_client(node_uuid)
+        snapshot_key = self.data_proxy.get_node_snapshot_key(node_uuid)
+        latest = client.xrevrange(snapshot_key, max='+', min='-', count=1)
+
+        state, stream_id = self.replay(node_uuid)
+        if stream_id is None:
+            return None
+
+        if latest and latest[0][1][b'stream_id'].decode() == stream_id:
+            # Nothing new since the last snapshot
+            return None
+
+        node_def = self.data_proxy.load_nodes([node_uuid])[node_uuid]
+        if node_def is not None:
+            state['synthesis'] = node_def['synthesis']
+            state['attributes'] = node_def['attributes']
+
+        client.xadd(snapshot_key, {
+            'stream_id': stream_id,
+            'state': json.dumps(state, separators=(',', ':'))
+        }, maxlen=self.keep, approximate=False)
+
+        self.compact(node_uuid)
+        return stream_id
+
+    def get_trim_id(self, node_uuid):
+        '''
+        The first node stream id that must be kept: the entry after the oldest retained snapshot,
+        or anything still undelivered or unacknowledged in a consumer group if that's older.
+        Nothing is trimmed before a consumer group exists.
+
+        :returns: stream id or None if nothing can be trimmed
+        '''
+
+        client = self.data_proxy.get_client(node_uuid)
+        snapshot_key = self.data_proxy.get_node_snapshot_key(node_uuid)
+        snapshots = client.xrange(snapshot_key, min='-', max='+', count=1)
+        if not snapshots:
+            return None
+
+        trim_id = next_stream_id(snapshots[0][1][b'stream_id'])
+
+        stream_key = self.data_proxy.get_node_stream_key(node_uuid)
+        groups = client.xinfo_groups(stream_key)
+        if not groups:
+            return None
+
+        for group in groups:
+            group_ids = [next_stream_id(group['last-delivered-id'])]
+
+            pending = client.xpending(stream_key, group['name'])
+            if pending['pending']:
+                group_ids.append(pending['min'])
+
+            for group_id in group_ids:
+                if parse_stream_id(group_id) < parse_stream_id(trim_id):
+                    trim_id = group_id if type(group_id) is str else group_id.decode()
+
+        return trim_id
+
+    def compact(self, node_uuid):
+        '''
+        :returns: number of node stream entries removed
+        '''
+
+        trim_id = self.get_trim_id(node_uuid)
+        if not trim_id:
+            return 0
+
+        stream_key = self.data_proxy.get_node_stream_key(node_uuid)
+        return self.trim_script(keys=[stream_key], args=[trim_id],
+                                client=self.data_proxy.get_client(node_uuid))
+
+    def snapshot_all(self):
+        '''
+        Snapshot every node with stream entries since its last snapshot
+
+        :returns: number of nodes snapshotted
+        '''
+
+        num_snapshots = 0
+        for node_uuid, stream_key in self.data_proxy.scan_node_streams():
+            try:
+                if self.snapshot(node_uuid):
+                    num_snapshots += 1
+            except Exception:
+                # TODO: Setup a proper log sink
+                traceback.print_exc()
+
+        return num_snapshots
+
+    def rebuild_graph(self, until=None, batch_size=500):
+        '''
+        Replay every node with a stream
+
+        :param until: stream id or epoch timestamp for a point-in-time read, None for the latest
+        :returns: dict of node_uuid -> state dict
+        '''
+
+        states = {}
+        batch = []
+        for node_uuid, _ in self.data_proxy.scan_node_streams():
+            batch.append(node_uuid)
+            if len(batch) >= batch_size:
+                states.update((k, v[0]) for k, v in self.replay_nodes(batch, until=until).items())
+                batch = []
+
+        if batch:
+            states.update((k, v[0]) for k, v in self.replay_nodes(batch, until=until).items())
+
+        return states
+
+    def restore(self, state):
+        '''
+        Write a replayed state back as the node record. Points aren't replayed, they stay in
+        NODE-POINTS-{uuid}.
+        '''
+
+        from node import Node
+
+        node = Node(self.data_proxy, uuid=state['uuid'], attributes=state['attributes'],
+                    load=False)
+        node.synthesis = state['synthesis']
+        node.outgoing = state['outgoing'][:]
+        node.incoming = state['incoming'][:]
+        node.save(force=True)
+
+        return node
+
+
+if __name__ == '__main__':
+    from data_proxy.redis import RedisProxy
+
+    parser = argparse.ArgumentParser(description='Node snapshots and replay')
+    parser.add_argument('command', choices=('snapshot', 'rebuild'))
+    parser.add_argument('--interval', type=int, default=0,
+                        help='Repeat the snapshot every interval seconds')
+    parser.add_argument('--until', type=float, default=None,
+                        help='Epoch timestamp for a point-in-time rebuild')
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'redis'))
+    args = parser.parse_args()
+
+    event_store = EventStore(RedisProxy(StrictRedis(host=args.redis_host, db=0)))
+
+    while True:
+        start_time = time.time()
+        if args.command == 'snapshot':
+            num = event_store.snapshot_all()
+        else:
+            num = len(event_store.rebuild_graph(until=args.until))
+        print('%s: %d nodes in %.2fs' % (args.command, num, time.time() - start_time))
+
+        if args.command != 'snapshot' or not args.interval:
+            sys.exit(0)
+        time.sleep(args.interval)
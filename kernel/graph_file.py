@@ -0,0 +1,355 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime as dt
+from array import array
+
+import numpy as np
+
+from data_proxy.redis import BaseDataProxy
+
+
+# Format version written to meta.json
+GRAPH_FILE_VERSION = 1
+
+# The columns of a graph file, one .npy each
+GRAPH_FILE_ARRAYS = (
+    'uuids',            # S bytes, sorted, the row of each node
+    'outgoing_indptr',  # int64, CSR row offsets into outgoing_indices
+    'outgoing_indices',  # int64, rows of the outgoing nodes, in connection order
+    'incoming_indptr',
+    'incoming_indices',
+    'point_indptr',     # int64, row offsets into the point columns
+    'point_times',      # float64, ascending within a row
+    'point_uuids',      # S bytes
+    'record_indptr',    # int64, offsets into records, an empty record is a missing node
+    'records'           # uint8, JSON of each node's synthesis and attributes
+)
+
+
+def export_graph_file(data_proxy, path, batch_size=1000):
+    '''
+    Write every node, its connections and its point times to a directory of .npy columns, which
+    GraphFileProxy maps back without parsing. Nodes are read in pipelined batches.
+
+    Connections to nodes that don't exist are dropped and counted as dangling. The directory is
+    written under a temporary name and moved into place when complete.
+
+    :param data_proxy: RedisProxy
+    :param path: output directory, replaced if it exists
+    :returns: the meta dict also written to meta.json
+    '''
+
+    start_time = time.time()
+    node_uuids = sorted(set(data_proxy.scan_node_uuids()))
+    rows = dict((node_uuid, i) for i, node_uuid in enumerate(node_uuids))
+
+    columns = {
+        'outgoing_indptr': array('q', [0]),
+        'outgoing_indices': array('q'),
+        'incoming_indptr': array('q', [0]),
+        'incoming_indices': array('q'),
+        'point_indptr': array('q', [0]),
+        'point_times': array('d'),
+        'record_indptr': array('q', [0])
+    }
+    point_uuids = []
+    records = bytearray()
+    dangling = 0
+
+    def load_points(client, node_uuids):
+        pipe = client.pipeline(transaction=False)
+        for node_uuid in node_uuids:
+            pipe.zrange(data_proxy.get_node_points_key(node_uuid), 0, -1, withscores=True)
+        return list(zip(node_uuids, pipe.execute()))
+
+    for start in range(0, len(node_uuids), batch_size):
+        batch = node_uuids[start:start + batch_size]
+        node_defs = data_proxy.load_nodes(batch)
+
+        points = {}
+        for client_results in data_proxy.map_clients(load_points, batch):
+            points.update(client_results)
+
+        for node_uuid in batch:
+            node_def = node_defs[node_uuid] or {'outgoing': [], 'incoming': []}
+
+            for direction in ('outgoing', 'incoming'):
+                indices = columns[direction + '_indices']
+                for other_uuid in node_def[direction]:
+                    if other_uuid in rows:
+                        indices.append(rows[other_uuid])
+                    else:
+                        dangling += 1
+                columns[direction + '_indptr'].append(len(indices))
+
+            for point_uuid, point_timestamp in points[node_uuid]:
+                point_uuids.append(point_uuid)
+                columns['point_times'].append(point_timestamp)
+            columns['point_indptr'].append(len(columns['point_times']))
+
+            # Deleted since the scan, stays as an empty record
+            if node_defs[node_uuid] is not None:
+                records += json.dumps({
+                    'synthesis': node_def['synthesis'],
+                    'attributes': node_def['attributes']
+                }, separators=(',', ':')).encode()
+            columns['record_indptr'].append(len(records))
+
+    tmp_path = path.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    def save(name, values):
+        np.save(os.path.join(tmp_path, name + '.npy'), values, allow_pickle=False)
+
+    save('uuids', np.array([u.encode() for u in node_uuids], dtype='S36'))
+    save('point_uuids', np.array(point_uuids, dtype='S36'))
+    save('records', np.frombuffer(bytes(records), dtype=np.uint8))
+    for name, values in columns.items():
+        save(name, np.frombuffer(values, dtype=values.typecode))
+
+    meta = {
+        'version': GRAPH_FILE_VERSION,
+        'exported_at': time.time(),
+        'num_nodes': len(node_uuids),
+        'num_edges': len(columns['outgoing_indices']),
+        'num_points': len(point_uuids),
+        'dangling': dangling,
+        'seconds': time.time() - start_time
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    return meta
+
+
+class GraphFileProxy(BaseDataProxy):
+    '''
+    A read-only data proxy over a graph file written by export_graph_file(). The columns are
+    memory-mapped, so opening one is near-instant whatever its size, and pages are only read as
+    they're touched. Node, LazyNode and query_outgoing work as they do against redis; anything
+    that writes raises NodeSaveError or PointSaveError.
+
+    Offline code can also use get_adjacency() to work on the CSR arrays directly.
+
+    :param path: graph file directory
+    :param mmap: If False, read the columns into memory instead
+    '''
+
+    def __init__(self, path, mmap=True):
+        super().__init__()
+
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        if self.meta['version'] != GRAPH_FILE_VERSION:
+            raise self.NodeSerializationError('Unsupported graph file version %s' %
+                                              self.meta['version'])
+
+        for name in GRAPH_FILE_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'),
+                                        mmap_mode='r' if mmap else None, allow_pickle=False))
+
+    def __repr__(self):
+        return '<GraphFileProxy %s, %d nodes>' % (self.path, self.meta['num_nodes'])
+
+    def get_row(self, node_uuid):
+        '''
+        :returns: the node's row, or None if it isn't in the file
+        '''
+
+        key = node_uuid.encode()
+        i = int(np.searchsorted(self.uuids, key))
+        if i < len(self.uuids) and self.uuids[i] == key:
+            return i
+        return None
+
+    def get_adjacency(self, direction='outgoing'):
+        '''
+        :returns: (indptr, indices) CSR arrays, row i's neighbours are
+            indices[indptr[i]:indptr[i + 1]]
+        '''
+
+        return getattr(self, direction + '_indptr'), getattr(self, direction + '_indices')
+
+    def get_neighbours(self, row, direction):
+        indptr, indices = self.get_adjacency(direction)
+        rows = indices[indptr[row]:indptr[row + 1]]
+        return [u.decode() for u in self.uuids[rows].tolist()]
+
+    def get_record(self, row):
+        start, end = self.record_indptr[row], self.record_indptr[row + 1]
+        if start == end:
+            return None
+        return json.loads(self.records[start:end].tobytes())
+
+    def scan_node_uuids(self, count=1000):
+        for node_uuid in self.uuids:
+            yield node_uuid.decode()
+
+    def load_node(self, node_uuid, fields=None, attrs=None, use_filter=True):
+        '''
+        :raises NodeNotFoundError:
+        '''
+
+        return self.load_nodes([node_uuid], fields=fields, attrs=attrs, strict=True)[node_uuid]
+
+    def load_nodes(self, node_uuids, fields=None, attrs=None, strict=False, use_filter=True):
+        '''
+        Node definitions, projected like RedisProxy.load_nodes. There's no node filter, so
+        use_filter is ignored.
+
+        :returns: dict of node_uuid -> node definition (or None if missing)
+        :raises NodeNotFoundError:
+        '''
+
+        full = fields is None or 'attributes' in fields
+        if fields is None:
+            fields = self.NODE_FIELDS
+
+        node_defs = {}
+        for node_uuid in node_uuids:
+            row = self.get_row(node_uuid)
+            record = self.get_record(row) if row is not None else None
+            if record is None:
+                if strict:
+                    raise self.NodeNotFoundError('Node not found: %s' % node_uuid)
+                node_defs[node_uuid] = None
+                continue
+
+            node_def = {'uuid': node_uuid, 'version': 0}
+            for direction in ('outgoing', 'incoming'):
+                if direction in fields:
+                    node_def[direction] = self.get_neighbours(row, direction)
+
+            if 'synthesis' in fields:
+                node_def['synthesis'] = record['synthesis']
+
+            if full:
+                node_def['attributes'] = record['attributes']
+            else:
+                node_def['attributes'] = dict((k, record['attributes'][k]) for k in (attrs or [])
+                                              if k in record['attributes'])
+
+            node_defs[node_uuid] = node_def
+
+        return node_defs
+
+    def filter_nodes(self, node_uuids, predicates):
+        attrs = list(set(attr for attr, _, _ in predicates))
+        node_defs = self.load_nodes(node_uuids, fields=[], attrs=attrs)
+        return [u for u in node_uuids
+                if node_defs[u] is not None
+                and self.match_predicates(node_defs[u]['attributes'], predicates)]
+
+    def get_histories(self, node_uuids, anchor_timestamp=None, window=None, limit=None):
+        '''
+        Point columns per node, like RedisProxy.get_histories
+
+        :returns: dict of node_uuid -> {'uuid': [point_uuid], 'timestamp_epoch': [timestamp]},
+            newest first
+        '''
+
+        if not anchor_timestamp:
+            anchor_timestamp = time.time()
+
+        histories = {}
+        for node_uuid in node_uuids:
+            row = self.get_row(node_uuid)
+            if row is None:
+                histories[node_uuid] = {'uuid': [], 'timestamp_epoch': []}
+                continue
+
+            start, end = self.point_indptr[row], self.point_indptr[row + 1]
+            times = self.point_times[start:end]
+
+            last = start + int(np.searchsorted(times, anchor_timestamp, side='right'))
+            first = start
+            if window:
+                first += int(np.searchsorted(times, anchor_timestamp - window, side='left'))
+            if limit:
+                first = max(first, last - limit)
+
+            histories[node_uuid] = {
+                'uuid': self.point_uuids[first:last][::-1].tolist(),
+                'timestamp_epoch': self.point_times[first:last][::-1].tolist()
+            }
+
+        return histories
+
+    def get_node_history(self, node,
+                         anchor_timestamp=None,
+                         window=None,
+                         limit=None):
+
+        history = self.get_histories([node.uuid], anchor_timestamp=anchor_timestamp,
+                                     window=window, limit=limit)[node.uuid]
+
+        result = []
+        for point_uuid, point_timestamp in zip(history['uuid'], history['timestamp_epoch']):
+            result.append({
+                'uuid': point_uuid,
+                'timestamp_epoch': point_timestamp,
+                'timestamp_utc': dt.datetime.fromtimestamp(point_timestamp, dt.timezone.utc)
+            })
+
+        return result
+
+    def get_point(self, node_uuid, point_uuid):
+        row = self.get_row(node_uuid)
+        if row is not None:
+            start, end = self.point_indptr[row], self.point_indptr[row + 1]
+            key = point_uuid.encode() if type(point_uuid) is str else point_uuid
+            for i in np.flatnonzero(self.point_uuids[start:end] == key):
+                return float(self.point_times[start + i])
+
+        raise self.PointNotFoundError('Point not found')
+
+    def save_node(self, node, force=False):
+        raise self.NodeSaveError('Graph file is read-only')
+
+    def delta(self, action, **kwargs):
+        raise self.NodeSaveError('Graph file is read-only')
+
+    def create_point(self, node, timestamp):
+        raise self.PointSaveError('Graph file is read-only')
+
+    def create_points(self, node, timestamps):
+        raise self.PointSaveError('Graph file is read-only')
+
+    def create_point_with_signal(self, node, timestamp, *args, **kwargs):
+        raise self.PointSaveError('Graph file is read-only')
+
+    def create_points_with_signal(self, node, timestamps, *args, **kwargs):
+        raise self.PointSaveError('Graph file is read-only')
+
+    def update_point(self, point):
+        raise self.PointSaveError('Graph file is read-only')
+
+
+if __name__ == '__main__':
+    from redis import StrictRedis
+    from data_proxy.redis import RedisProxy
+
+    parser = argparse.ArgumentParser(description='Export the graph to a memory-mapped file')
+    parser.add_argument('path', help='Output directory')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'redis'))
+    args = parser.parse_args()
+
+    data_proxy = RedisProxy(StrictRedis(host=args.redis_host, db=0))
+    meta = export_graph_file(data_proxy, args.path, batch_size=args.batch_size)
+    print('Exported %d nodes, %d edges, %d points in %.2fs (%d dangling connections)' % (
+        meta['num_nodes'], meta['num_edges'], meta['num_points'], meta['seconds'],
+        meta['dangling']))
+    sys.exit(0)
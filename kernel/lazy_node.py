@@ -0,0 +1,232 @@
+from node import Node
+
+
+class NodeBatch():
+    '''
+    A per-traversal identity map and fetch batch for LazyNode handles. Handles created through
+    the same batch are loaded together, in one pipelined round trip, the first time any of them
+    is accessed.
+
+    :param data_proxy:
+    '''
+
+    def __init__(self, data_proxy):
+        self.data_proxy = data_proxy
+        self.nodes = {}
+        self.pending = []
+
+    def __repr__(self):
+        return '<NodeBatch %d nodes, %d pending>' % (len(self.nodes), len(self.pending))
+
+    def node(self, uuid, fields=None, attrs=None):
+        '''
+        Get the handle for a node, creating it if this batch hasn't seen the uuid yet
+
+        :param fields: projection to load on first access (see BaseDataProxy.NODE_FIELDS),
+            None for the full node
+        :param attrs: attribute names to load alongside the fields
+        :returns: LazyNode
+        '''
+
+        lazy_node = self.nodes.get(uuid)
+        if not lazy_node:
+            lazy_node = LazyNode(self.data_proxy, uuid, fields=fields, attrs=attrs, batch=self)
+        return lazy_node
+
+    def add(self, lazy_node):
+        self.nodes[lazy_node.uuid] = lazy_node
+        self.pending.append(lazy_node)
+        lazy_node.pending = True
+
+    def fetch(self):
+        '''
+        Load every pending handle, one pipeline per distinct projection
+
+        :returns: list of uuids that weren't found
+        '''
+
+        pending, self.pending = self.pending, []
+
+        projections = {}
+        for lazy_node in pending:
+            key = (lazy_node.fields, lazy_node.attrs)
+            projections.setdefault(key, []).append(lazy_node)
+
+        missing = []
+        for (fields, attrs), lazy_nodes in projections.items():
+            node_defs = self.data_proxy.load_nodes([n.uuid for n in lazy_nodes],
+                                                   fields=fields, attrs=attrs)
+            for lazy_node in lazy_nodes:
+                node_def = node_defs.get(lazy_node.uuid)
+                lazy_node.pending = False
+                lazy_node.apply(node_def)
+                if node_def is None:
+                    missing.append(lazy_node.uuid)
+
+        return missing
+
+
+class LazyNode(Node):
+    '''
+    A Node handle that defers loading until one of its fields is first accessed, and then loads
+    only its projection, shared with every other pending handle in its NodeBatch. Fields outside
+    the projection are fetched individually if and when they are accessed.
+
+    :param data_proxy:
+    :param uuid:
+    :param fields: projection to load on first access, None for the full node
+    :param attrs: attribute names to load alongside the fields
+    :param batch: NodeBatch to join, a private one if None
+    :returns: LazyNode
+    '''
+
+    def __init__(self, data_proxy, uuid, fields=None, attrs=None, batch=None):
+        # Node.__init__ isn't called, it would assign (and so mark as loaded) every field
+        self.data_proxy = data_proxy
+        self.uuid = uuid
+        self.saved = True
+        self.loaded = False
+        self.dirty = False
+        self.missing = False
+        self.pending = False
+
+        self.fields = tuple(fields) if fields is not None else None
+        self.attrs = tuple(attrs) if attrs else None
+
+        self._values = {}
+        self._attrs = {}
+
+        self.batch = batch or NodeBatch(data_proxy)
+        self.batch.add(self)
+
+    def __repr__(self):
+        return '<LazyNode %s>' % self.uuid
+
+    def apply(self, node_def):
+        '''
+        Set the state from a (possibly projected) node definition
+        '''
+
+        if node_def is None:
+            self.missing = True
+            return
+
+        full = self.fields is None or 'attributes' in self.fields
+        for field, value in node_def.items():
+            if field == 'attributes' and not full:
+                self._attrs.update(value)
+            elif field != 'uuid':
+                self._values[field] = value
+
+        if full:
+            self.loaded = True
+
+    def fetch_field(self, field):
+        if self.pending:
+            self.batch.fetch()
+
+        if self.missing:
+            raise self.data_proxy.NodeNotFoundError('Node not found: %s' % self.uuid)
+
+        if field not in self._values:
+            node_def = self.data_proxy.load_node(self.uuid, fields=[field])
+            self._values[field] = node_def[field]
+
+        return self._values[field]
+
+    def get_field(self, field):
+        if field in self._values:
+            return self._values[field]
+        return self.fetch_field(field)
+
+    @property
+    def incoming(self):
+        return self.get_field('incoming')
+
+    @incoming.setter
+    def incoming(self, value):
+        self._values['incoming'] = value
+
+    @property
+    def outgoing(self):
+        return self.get_field('outgoing')
+
+    @outgoing.setter
+    def outgoing(self, value):
+        self._values['outgoing'] = value
+
+    @property
+    def synthesis(self):
+        return self.get_field('synthesis')
+
+    @synthesis.setter
+    def synthesis(self, value):
+        self._values['synthesis'] = value
+
+    @property
+    def version(self):
+        return self.get_field('version')
+
+    @version.setter
+    def version(self, value):
+        self._values['version'] = value
+
+    @property
+    def attributes(self):
+        return self.get_field('attributes')
+
+    @attributes.setter
+    def attributes(self, value):
+        self._values['attributes'] = value
+
+    def attr(self, key):
+        if 'attributes' in self._values:
+            return self._values['attributes'].get(key)
+
+        if key not in self._attrs:
+            if self.pending:
+                self.batch.fetch()
+
+            if self.missing:
+                raise self.data_proxy.NodeNotFoundError('Node not found: %s' % self.uuid)
+
+            if 'attributes' in self._values:
+                return self._values['attributes'].get(key)
+
+            if key not in self._attrs:
+                node_def = self.data_proxy.load_node(self.uuid, fields=[], attrs=[key])
+                self._attrs[key] = node_def['attributes'].get(key)
+
+        return self._attrs[key]
+
+    def load(self, use_filter=True):
+        node_def = super().load(use_filter=use_filter)
+        self.missing = False
+        return node_def
+
+    def save(self, force=False):
+        # A partial node would overwrite the fields that weren't loaded
+        for field in self.data_proxy.NODE_FIELDS:
+            self.get_field(field)
+
+        super().save(force=force)
+
+
+def get_or_create(data_proxy, uuid):
+    '''
+    A handle on a node for writes that only need it to exist, such as adding points, creating the
+    node first if it doesn't. An existing node costs one projected read of its uuid and version,
+    never its edges or attributes, and no write. A node the node filter's replica rules out is
+    created without a read, the create-if-absent save covering a node created meanwhile.
+
+    :returns: LazyNode, or the Node if it was just created
+    '''
+
+    if data_proxy.might_exist(uuid, exact=False):
+        lazy_node = LazyNode(data_proxy, uuid, fields=[])
+        if not lazy_node.batch.fetch():
+            return lazy_node
+
+    node = Node(data_proxy, uuid=uuid, load=False)
+    node.create_or_load()
+    return node
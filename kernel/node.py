@@ -20,6 +20,58 @@ class GraphTraversalError(Exception):
     pass
 
 
+def calc_period(pts, anchor_timestamp, num_points=5):
+    '''
+    The score period and recency from point times
+
+    :param pts: point timestamps sorted newest first
+    :param num_points: how many of the newest points to average the interval over
+    :returns: (average interval, seconds since the newest point or None if fewer than two points)
+    '''
+
+    def calc_avg_interval(pts, anchor_time=None):
+        # pts sorted high to low
+        intervals = []
+        last_time = anchor_time
+        for point_time in pts:
+            if last_time:
+                intervals.append(last_time - point_time)
+            last_time = point_time
+
+        return sum(intervals) / len(intervals)
+
+    last_event_time = None
+    score_interval = 0
+    if len(pts) > 1:
+        score_interval = calc_avg_interval(pts[:num_points])
+        last_event_time = pts[0]
+
+    time_since = None
+    if last_event_time:
+        time_since = anchor_timestamp - last_event_time
+
+    return score_interval, time_since
+
+
+def build_score_func(period, time_since, anchor_timestamp, decay):
+    '''
+    :returns: wave function definition, or None if there's no recency (see calc_period)
+    '''
+
+    if time_since is None:
+        return None
+
+    return {
+        'ref_time': anchor_timestamp - time_since,
+        'period': period * 1.0,
+        'decay': decay,
+        'funcs': [{
+            'func': 'sin',
+            'phase': 0
+        }]
+    }
+
+
 class Node():
     '''
     Construct a new Node, the backbone of the data structure.
@@ -27,6 +79,8 @@ class Node():
     :param data_proxy:
     :param uuid: uuid as produced by str(uuid4())
     :param load: If True, load now. Otherwise must call load().
+    :param create: If True, save the node now unless the ID already exists, in which case it's
+        loaded instead
     :returns: Node
     :raises BaseDataProxy.NodeNotFoundError: If create=False and load=True but the ID is not
                 found in the data layer.
@@ -36,6 +90,14 @@ class Node():
     NodeNotSavedError = NodeNotSavedError
     GraphIntegrityError = GraphIntegrityError
 
+    # Score function parameters, mirrored by the create_point script in data_proxy.scripts
+    SCORE_WINDOW = 86400 * 30
+    SCORE_DECAY = 0.2
+    SCORE_INTERVAL_POINTS = 5
+
+    # Attempts at merging commutative edits into a concurrently changed node, see save_merged()
+    SAVE_RETRIES = 5
+
     def __init__(self, data_proxy, uuid=None, attributes=None, load=True, create=False):
         self.data_proxy = data_proxy
         self.saved = False
@@ -47,6 +109,9 @@ class Node():
         self.outgoing = []
         self.synthesis = None
 
+        # The stored version this node was loaded at, None until loaded or saved
+        self.version = None
+
         if not attributes or type(attributes) is not dict:
             attributes = {}
         self.attributes = attributes
@@ -56,48 +121,116 @@ class Node():
         else:
             self.uuid = uuid
             if create:
-                # TODO: Check that the UUID doesn't already exist
-                self.save()
+                self.load_or_create()
             elif load:
                 self.load()
 
     def __repr__(self):
         return '<Node %s>' % self.uuid
 
-    def load(self):
+    def load_or_create(self):
+        '''
+        Load the node, or save it if it doesn't exist yet. Where the data proxy's node filter says
+        the node may exist, which it usually does, that's a single read and no write. Otherwise
+        the save is tried first, see create_or_load(). The filter isn't asked to catch up, as a
+        node created meanwhile makes the save fail and load instead.
+        '''
+
+        if self.data_proxy.might_exist(self.uuid, exact=False):
+            try:
+                self.load()
+                return
+            except self.data_proxy.NodeNotFoundError:
+                pass
+
+        self.create_or_load()
+
+    def create_or_load(self):
+        '''
+        Save the node unless it exists, in which case it's loaded instead. The load bypasses the
+        node filter, which may not have seen the other writer's creation yet.
+        '''
+
+        try:
+            self.save()
+        except self.data_proxy.NodeConflictError:
+            self.load(use_filter=False)
+
+    def load(self, use_filter=True):
         '''
         Call the data proxy to retrieve the node details and set object state
 
+        :param use_filter: If False, read the node even if the node filter rules it out
         :returns: dict
         :raises BaseDataProxy.NodeNotFoundError:
                 BaseDataProxy.NodeSerializationError:
         '''
 
-        node_def = self.data_proxy.load_node(self.uuid)
+        node_def = self.data_proxy.load_node(self.uuid, use_filter=use_filter)
+        self.set_state(node_def)
+
+        return node_def
+
+    def set_state(self, node_def):
+        '''
+        Set object state from a full node definition, as loaded
+        '''
 
         self.incoming = node_def['incoming']
         self.outgoing = node_def['outgoing']
         self.synthesis = node_def['synthesis']
         self.attributes = node_def['attributes']
+        self.version = node_def.get('version', 0)
 
         self.loaded = True
         self.saved = True
         self.dirty = False
 
-        return node_def
-
-    def save(self):
+    def save(self, force=False):
         '''
         Call the data proxy to persist the current state
 
+        :param force: Overwrite the stored node even if it changed since this one was loaded
         :returns: None
-        :raises BaseDataProxy.NodeSaveError: Generally a problem with the data layer.
+        :raises BaseDataProxy.NodeConflictError: The stored node changed since it was loaded
+                BaseDataProxy.NodeSaveError: Generally a problem with the data layer.
         '''
 
-        self.data_proxy.save_node(self)
+        self.data_proxy.save_node(self, force=force)
         self.saved = True
         self.dirty = False
 
+    def save_merged(self, outgoing=(), incoming=(), retries=None):
+        '''
+        Save, and if another writer changed the node in the meantime, reload it, reapply the
+        connection additions and try again. Connection additions commute, so nothing is lost.
+        Only for nodes whose unsaved changes are those additions, anything else is discarded by
+        the reload.
+
+        :param outgoing: uuids added to outgoing since the node was loaded
+        :param incoming: uuids added to incoming since the node was loaded
+        :returns: None
+        :raises BaseDataProxy.NodeConflictError: Still conflicting after the retries
+        '''
+
+        if retries is None:
+            retries = self.SAVE_RETRIES
+
+        for attempt in range(retries + 1):
+            try:
+                return self.save()
+            except self.data_proxy.NodeConflictError:
+                if attempt == retries:
+                    raise
+
+            self.load()
+            for node_uuid in outgoing:
+                if node_uuid not in self.outgoing:
+                    self.outgoing.append(node_uuid)
+            for node_uuid in incoming:
+                if node_uuid not in self.incoming:
+                    self.incoming.append(node_uuid)
+
     def serialize(self):
         return {
             'uuid': self.uuid,
@@ -126,13 +259,23 @@ class Node():
         if self.uuid == node.uuid:
             raise self.GraphIntegrityError('Cannot connect to self')
 
-        self.add_outgoing(node)
-        node.add_incoming(self)
+        # Either side may be left saved alone by an earlier attempt that failed on the other
+        new = node.uuid not in self.outgoing or self.uuid not in node.incoming
+        self.add_outgoing(node, emit_delta=False)
+        node.add_incoming(self, emit_delta=False)
+
+        # Each side is saved with its own compare-and-set, merging concurrent connections. The
+        # deltas only go out once both sides are saved.
+        self.save_merged(outgoing=[node.uuid])
+        node.save_merged(incoming=[self.uuid])
 
-        # TODO: Wrap in a redis transaction to ensure atomicity
-        # TODO: Defer the delta output (below) until transaction suceeds
-        self.save()
-        node.save()
+        if new:
+            self.data_proxy.delta('AddOutgoingConnection',
+                                  node_uuid=self.uuid,
+                                  outgoing_node_uuid=node.uuid)
+            self.data_proxy.delta('AddIncomingConnection',
+                                  node_uuid=node.uuid,
+                                  incoming_node_uuid=self.uuid)
 
     def connect_from(self, node):
         '''
@@ -141,10 +284,24 @@ class Node():
 
         node.connect_to(self)
 
-    def get_outgoing(self):
+    def get_outgoing(self, concurrency=None, timeout=None):
+        '''
+        Load the nodes this one connects to, in parallel chunks for high-degree nodes
+
+        :param concurrency: chunks loaded at once, see BaseDataProxy.load_nodes_fanout
+        :param timeout: seconds
+        :returns: list of Node, in connection order
+        :raises BaseDataProxy.NodeNotFoundError:
+                BaseDataProxy.NodeLoadTimeoutError:
+        '''
+
+        node_defs = self.data_proxy.load_nodes_fanout(self.outgoing, strict=True,
+                                                      concurrency=concurrency, timeout=timeout)
+
         outgoing_nodes = []
         for outgoing_node_uuid in self.outgoing:
-            outgoing_node = Node(self.data_proxy, uuid=outgoing_node_uuid, load=True)
+            outgoing_node = Node(self.data_proxy, uuid=outgoing_node_uuid, load=False)
+            outgoing_node.set_state(node_defs[outgoing_node_uuid])
             outgoing_nodes.append(outgoing_node)
 
         return outgoing_nodes
@@ -169,41 +326,72 @@ class Node():
                                   node_uuid=self.uuid,
                                   incoming_node_uuid=node.uuid)
 
-    def query_outgoing(self, seen=None):
+    def query_outgoing(self, seen=None, predicates=None, use_cache=True):
         '''
         Traverse the graph to retrieve the set of nodes linked by outgoing connections. Has basic
             cycle prevention.
 
+        The traversal is breadth-first with one pipelined round trip per level, and only the
+        outgoing connections are loaded. The returned nodes are LazyNode handles, so any other
+        field is loaded on first access.
+
+        :param predicates: list of (attribute, op, value), e.g. [('status', '==', 'active')].
+            Nodes that don't match are pruned along with everything reachable only through them.
+            Evaluated by the data proxy from attribute indexes where declared, before any load.
+        :param use_cache: If the data proxy has a ReachabilityCache, answer unfiltered queries
+            from this node's cached descendant set, materializing it on the first query.
         :returns: dict of node_uuid -> Node
-        :raises GraphTraversalError: A wrapper around the Node constructor, typically representing
+        :raises GraphTraversalError: A wrapper around the Node load, typically representing
             a NodeNotFoundError or NodeSerializationError
         '''
 
+        from lazy_node import NodeBatch
+
         if not seen:
             seen = set([])
 
         result = {}
         result[self.uuid] = self
 
-        for outgoing_node_uuid in self.outgoing:
-            if seen and outgoing_node_uuid in seen:
-                continue
+        batch = NodeBatch(self.data_proxy)
+        frontier = [self]
+
+        reach_cache = self.data_proxy.reach_cache
+        if reach_cache and use_cache and not seen and not predicates:
+            descendants, _ = reach_cache.get_or_materialize(self)
+            for node_uuid in descendants:
+                result[node_uuid] = batch.node(node_uuid, fields=('outgoing',))
+            return result
+
+        while frontier:
+            candidates = []
+            for node in frontier:
+                for outgoing_node_uuid in node.outgoing:
+                    if outgoing_node_uuid in seen or outgoing_node_uuid in result:
+                        continue
+
+                    seen.add(outgoing_node_uuid)
+                    candidates.append(outgoing_node_uuid)
+
+            if predicates and candidates:
+                candidates = self.data_proxy.filter_nodes(candidates, predicates)
+
+            next_frontier = []
+            for outgoing_node_uuid in candidates:
+                outgoing_node = batch.node(outgoing_node_uuid, fields=('outgoing',))
+                result[outgoing_node_uuid] = outgoing_node
+                next_frontier.append(outgoing_node)
 
             try:
-                # NOTE: While it's clearly inefficient to make a round-trip call for each Node,
-                # right now the primary concern is whether or not this design achieves the
-                # high-level goal.
-                outgoing_node = Node(self.data_proxy, uuid=outgoing_node_uuid, load=True)
+                missing = batch.fetch()
+                if missing:
+                    raise self.data_proxy.NodeNotFoundError('Node not found: %s' % missing[0])
             except Exception as e:
                 # TODO: Setup a proper log sink
                 traceback.print_exc()
                 raise self.GraphTraversalError(e)
-            else:
-                result[outgoing_node_uuid] = outgoing_node
-                seen.add(outgoing_node_uuid)
 
-                outgoing_result = outgoing_node.query_outgoing(seen=seen)
-                result.update(outgoing_result)
+            frontier = next_frontier
 
         return result
 
@@ -222,62 +410,32 @@ class Node():
             anchor_timestamp = math.ceil(time.time())
 
         if not window:
-            window = (86400 * 30)
-
-        def calc_avg_interval(pts, anchor_time=None):
-            # pts sorted high to low
-            intervals = []
-            last_time = anchor_time
-            for point_time in pts:
-                if last_time:
-                    intervals.append(last_time - point_time)
-                last_time = point_time
+            window = self.SCORE_WINDOW
 
-            return sum(intervals) / len(intervals)
-
-        points = self.get_history(anchor_timestamp=anchor_timestamp, window=window)
+        # Only the newest points enter the period
+        points = self.get_history(anchor_timestamp=anchor_timestamp, window=window,
+                                  limit=self.SCORE_INTERVAL_POINTS)
 
         pts = [p['timestamp_epoch'] for p in points]
         pts.sort(reverse=True)  # Sort largest (newest) to smallest (oldest)
-        pts = pts[:10]
-
-        recent_interval_5 = 1
-        last_event_time = None
-        score_interval = 0
-        if len(pts) > 1:
-            recent_interval_5 = calc_avg_interval(pts[:5])
-
-            score_interval = recent_interval_5
-            last_event_time = pts[0]
 
-        time_since = None
-        if last_event_time:
-            time_since = anchor_timestamp - last_event_time
-
-        return score_interval, time_since
+        return calc_period(pts, anchor_timestamp, num_points=self.SCORE_INTERVAL_POINTS)
 
     def get_score_func(self, anchor_timestamp=None, window=None, serialized=False):
         if not anchor_timestamp:
             anchor_timestamp = math.ceil(time.time())
 
         if not window:
-            window = (86400 * 30)
+            window = self.SCORE_WINDOW
 
         period, time_since = self.get_period(anchor_timestamp=anchor_timestamp,
                                              window=window)
 
-        if time_since is None:
+        wave_func_def = build_score_func(period, time_since, anchor_timestamp,
+                                         decay=self.SCORE_DECAY)
+        if wave_func_def is None:
             return None
 
-        wave_func_def = {
-            'ref_time': anchor_timestamp - time_since,
-            'period': period * 1.0,
-            'decay': 0.2,
-            'funcs': [{
-                'func': 'sin',
-                'phase': 0
-            }]
-        }
         wave_func = WaveFunc(serialized=wave_func_def)
         if serialized:
             return wave_func.serialize()
@@ -298,24 +456,110 @@ class Node():
                                                 window=window,
                                                 limit=limit)
 
-    def create_point(self, timestamp_epoch=None):
+    def create_point(self, timestamp_epoch=None, signal=True):
+        '''
+        Persist a new point for this node
+
+        :param timestamp_epoch: point time, defaults to now
+        :param signal: If True, recompute and publish the node signal before returning. Pass
+            False when a signal_worker is consuming the node streams.
+        :returns: Point
+        '''
+
         if not timestamp_epoch:
             timestamp_epoch = time.time()
 
-        point_uuid = self.data_proxy.create_point(self, timestamp_epoch)
-        wave_func = self.get_score_func()
-        if wave_func:
-            self.data_proxy.delta('NodeSignal',
-                                  node_uuid=self.uuid,
-                                  wave_func=wave_func.serialize())
+        if signal:
+            # Insert, delta and signal are written atomically by a server-side script
+            point_uuid, wave_func_def = self.data_proxy.create_point_with_signal(
+                self, timestamp_epoch,
+                anchor_timestamp=math.ceil(time.time()),
+                window=self.SCORE_WINDOW,
+                decay=self.SCORE_DECAY,
+                num_points=self.SCORE_INTERVAL_POINTS)
+        else:
+            point_uuid = self.data_proxy.create_point(self, timestamp_epoch)
+
         return Point(self.data_proxy, self.uuid,
                      uuid=point_uuid,
                      timestamp_epoch=timestamp_epoch,
                      load=False)
 
+    def create_points(self, timestamps, signal=True):
+        '''
+        Persist many points for this node at once, e.g. a deferred batch
+
+        :param timestamps: list of point times
+        :param signal: If True, recompute and publish the node signal once, atomically with the
+            insert as in create_point()
+        :returns: list of Point
+        '''
+
+        if signal:
+            point_uuids, _ = self.data_proxy.create_points_with_signal(
+                self, timestamps,
+                anchor_timestamp=math.ceil(time.time()),
+                window=self.SCORE_WINDOW,
+                decay=self.SCORE_DECAY,
+                num_points=self.SCORE_INTERVAL_POINTS)
+        else:
+            point_uuids = self.data_proxy.create_points(self, timestamps)
+
+        return [Point(self.data_proxy, self.uuid, uuid=point_uuid, timestamp_epoch=timestamp,
+                      load=False)
+                for point_uuid, timestamp in zip(point_uuids, timestamps)]
+
+    def update_signal(self, anchor_timestamp=None):
+        '''
+        Recompute the score function from history and publish it as the NodeSignal
+
+        :returns: WaveFunc or None if there isn't enough history
+        '''
+
+        wave_func = self.get_score_func(anchor_timestamp=anchor_timestamp)
+        if wave_func:
+            self.data_proxy.delta('NodeSignal',
+                                  node_uuid=self.uuid,
+                                  wave_func=wave_func.serialize())
+        return wave_func
+
     def get_point(self, point_uuid):
         timestamp_epoch = self.data_proxy.get_point(self.uuid, point_uuid)
         return Point(self.data_proxy, self.uuid,
                      uuid=point_uuid,
                      timestamp_epoch=timestamp_epoch,
                      load=False)
+
+
+def get_score_funcs(data_proxy, node_uuids, anchor_timestamp=None, window=None, serialized=False):
+    '''
+    Node.get_score_func() for many nodes, from a single multi-node history read
+
+    :returns: dict of node_uuid -> WaveFunc (serialized as dict if serialized), or None if there
+        isn't enough history
+    '''
+
+    if not anchor_timestamp:
+        anchor_timestamp = math.ceil(time.time())
+
+    if not window:
+        window = Node.SCORE_WINDOW
+
+    histories = data_proxy.get_histories(node_uuids, anchor_timestamp=anchor_timestamp,
+                                         window=window, limit=Node.SCORE_INTERVAL_POINTS)
+
+    score_funcs = {}
+    for node_uuid, history in histories.items():
+        period, time_since = calc_period(history['timestamp_epoch'], anchor_timestamp,
+                                         num_points=Node.SCORE_INTERVAL_POINTS)
+
+        wave_func_def = build_score_func(period, time_since, anchor_timestamp,
+                                         decay=Node.SCORE_DECAY)
+        if wave_func_def is None:
+            score_funcs[node_uuid] = None
+            continue
+
+        wave_func = WaveFunc(serialized=wave_func_def)
+        score_funcs[node_uuid] = wave_func.serialize() if serialized else wave_func
+
+    return score_funcs
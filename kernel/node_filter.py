@@ -0,0 +1,244 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import argparse
+import traceback
+from threading import Lock
+
+from redis import StrictRedis
+
+
+class NodeFilter():
+    '''
+    In-process replica of the Bloom filter of node uuids that RedisProxy sets on every node
+    creation. A miss means the node doesn't exist, a hit that it probably does, about 1% of hits
+    being false, so a hit still needs a read.
+
+    The replica is a copy of the NODE-FILTER bitmap, caught up from the NODE-FILTER-LOG stream of
+    creations. Hits never go stale, as bits are only ever set, and are answered locally. For an
+    exact answer a miss is only trusted after catching up from the log, one XREAD for all the
+    misses of a call, which is far cheaper than reading the nodes. Callers that recover from a
+    stale miss, such as a create-if-absent save, take the local answer with exact=False and skip
+    the round trip. Creations by this process are visible at once.
+
+    Until the filter has been built with build(), which covers the nodes created before it
+    existed, every uuid is a hit, and the params key is checked every check_interval seconds.
+    Attaching the filter sets data_proxy.node_filter, which load_nodes() consults, and through it
+    Node(create=True) and lazy_node.get_or_create().
+
+    :param data_proxy: RedisProxy
+    :param check_interval: seconds
+    '''
+
+    def __init__(self, data_proxy, check_interval=10):
+        self.data_proxy = data_proxy
+        self.redis = data_proxy.redis
+        self.check_interval = check_interval
+
+        # The bitmap, None while the filter isn't built
+        self.bits = None
+
+        # The last log entry applied to the bits, and a count of the syncs started, so
+        # concurrent misses share one started after they arrived
+        self.last_id = None
+        self.syncs_started = 0
+        self.checked_at = 0
+
+        self.lock = Lock()
+
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'reloads': 0,
+            'refreshes': 0,
+            'errors': 0
+        }
+
+        data_proxy.node_filter = self
+
+    def get_offsets(self, node_uuid):
+        return self.data_proxy.get_node_filter_offsets(node_uuid)
+
+    def contains(self, node_uuid):
+        bits = self.bits
+        if bits is None:
+            return True
+
+        for offset in self.get_offsets(node_uuid):
+            if not bits[offset >> 3] & (0x80 >> (offset & 7)):
+                return False
+        return True
+
+    def add(self, node_uuid):
+        '''
+        Set a node's bits in the replica, for a creation by this process
+        '''
+
+        bits = self.bits
+        if bits is not None:
+            for offset in self.get_offsets(node_uuid):
+                bits[offset >> 3] |= 0x80 >> (offset & 7)
+
+    def reload(self):
+        '''
+        Copy the whole bitmap, if it's built with our parameters. The log position is read first,
+        so the creations it covers are already in the copy and the ones after it are applied by
+        the next refresh.
+        '''
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.data_proxy.get_node_filter_params_key())
+        pipe.xrevrange(self.data_proxy.get_node_filter_log_key(), max='+', min='-', count=1)
+        params, last_entries = pipe.execute()
+
+        self.checked_at = time.time()
+
+        if params != self.data_proxy.get_node_filter_params():
+            self.bits = None
+            self.last_id = None
+            return
+
+        data = self.redis.get(self.data_proxy.get_node_filter_key()) or b''
+        self.metrics['reloads'] += 1
+
+        bits = bytearray(self.data_proxy.NODE_FILTER_BITS // 8)
+        bits[:len(data)] = data
+
+        self.last_id = last_entries[0][0] if last_entries else b'0-0'
+        self.bits = bits
+
+    def refresh(self):
+        '''
+        Apply the creations logged since the last sync, reloading instead if the filter was
+        rebuilt or the log was trimmed past them
+        '''
+
+        if self.bits is None:
+            self.reload()
+            return
+
+        log_key = self.data_proxy.get_node_filter_log_key()
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.data_proxy.get_node_filter_params_key())
+        pipe.xrange(log_key, min='-', max='+', count=1)
+        pipe.xread({log_key: self.last_id})
+        params, first_entries, result = pipe.execute()
+
+        if params != self.data_proxy.get_node_filter_params():
+            self.reload()
+            return
+
+        if first_entries and self.id_key(first_entries[0][0]) > self.id_key(self.last_id):
+            # Entries after ours may have been trimmed
+            self.reload()
+            return
+
+        self.metrics['refreshes'] += 1
+        self.checked_at = time.time()
+
+        for _, entries in result or []:
+            for entry_id, fields in entries:
+                self.add(fields[b'uuid'].decode())
+                self.last_id = entry_id
+
+    def id_key(self, entry_id):
+        ms, seq = entry_id.split(b'-')
+        return int(ms), int(seq)
+
+    def get_missing(self, node_uuids, exact=True):
+        '''
+        :param exact: If False, answer from the replica as it is, which may report a node another
+            process just created as missing
+        :returns: list of the uuids of the nodes that don't exist
+        '''
+
+        syncs_started = self.syncs_started
+        built = self.bits is not None
+
+        missing = [u for u in node_uuids if not self.contains(u)]
+        if built and (not missing or not exact):
+            self.metrics['hits'] += len(node_uuids) - len(missing)
+            self.metrics['misses'] += len(missing)
+            return missing
+
+        if built or time.time() - self.checked_at > self.check_interval:
+            with self.lock:
+                # A sync started since this call began has seen every creation before it
+                if self.syncs_started == syncs_started:
+                    self.syncs_started += 1
+                    try:
+                        self.refresh()
+                    except Exception:
+                        # Unknown is a hit, the caller reads the nodes
+                        # TODO: Setup a proper log sink
+                        traceback.print_exc()
+                        self.metrics['errors'] += 1
+                        return []
+
+            candidates = missing if built else node_uuids
+            missing = [u for u in candidates if not self.contains(u)]
+
+        self.metrics['hits'] += len(node_uuids) - len(missing)
+        self.metrics['misses'] += len(missing)
+        return missing
+
+    def might_exist(self, node_uuid, exact=True):
+        '''
+        :param exact: See get_missing()
+        :returns: False only if the node doesn't exist
+        '''
+
+        return not self.get_missing([node_uuid], exact=exact)
+
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        metrics['built'] = self.bits is not None
+        return metrics
+
+    def build(self, batch_size=1000):
+        '''
+        Rebuild the filter from a scan of the node keys, dropping deleted nodes. Replicas treat
+        every uuid as a hit until it's done. Nodes created during the build set their own bits.
+
+        :returns: number of nodes added
+        '''
+
+        params_key = self.data_proxy.get_node_filter_params_key()
+        filter_key = self.data_proxy.get_node_filter_key()
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(params_key)
+        pipe.delete(filter_key)
+        pipe.execute()
+
+        num_nodes = 0
+        pipe = self.redis.pipeline(transaction=False)
+        for node_uuid in self.data_proxy.scan_node_uuids(count=batch_size):
+            for offset in self.get_offsets(node_uuid):
+                pipe.setbit(filter_key, offset, 1)
+            num_nodes += 1
+            if num_nodes % batch_size == 0:
+                pipe.execute()
+        pipe.set(params_key, self.data_proxy.get_node_filter_params())
+        pipe.execute()
+
+        self.reload()
+        return num_nodes
+
+
+if __name__ == '__main__':
+    from data_proxy.redis import RedisProxy
+
+    parser = argparse.ArgumentParser(description='Build the Bloom filter of node uuids')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'redis'))
+    args = parser.parse_args()
+
+    start_time = time.time()
+    node_filter = NodeFilter(RedisProxy(StrictRedis(host=args.redis_host, db=0)))
+    num_nodes = node_filter.build(batch_size=args.batch_size)
+    print('Added %d nodes to the node filter in %.2fs' % (num_nodes, time.time() - start_time))
+    sys.exit(0)
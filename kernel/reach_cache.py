@@ -0,0 +1,230 @@
+from redis.exceptions import WatchError
+
+
+class ReachabilityCache():
+    '''
+    Materialized descendant sets for the roots passed to Node.query_outgoing, so a repeat query
+    costs one set read rather than a traversal.
+
+    Each root has a set of descendant uuids (NODE-REACH-{uuid}) and a version stamp, bumped
+    whenever the set changes. The sets are kept current from the AddOutgoingConnection deltas:
+    edges are only ever added, so a new edge can only grow the sets of the roots that already
+    reach its source. The AddIncomingConnection delta mirrors the same edge and is ignored.
+
+    A root being materialized is registered in NODE-REACH-BUILDING before its traversal starts,
+    and the edges added meanwhile are queued for it (NODE-REACH-PENDING-{uuid}), as its partial
+    set can't tell whether they reach it. The queue is applied when the set is stored.
+
+    Deltas are only seen by the data proxy that emits them. The signal workers apply the edges
+    of every process from the node streams (see SignalWorker.add_edges), so materialized sets
+    trail edges written elsewhere by the worker lag. Attaching a cache to a writing proxy applies
+    its own edges at once; add_edge() is idempotent, so applying an edge twice is harmless.
+
+    :param data_proxy: RedisProxy, the cache attaches itself to it
+    '''
+
+    def __init__(self, data_proxy):
+        self.data_proxy = data_proxy
+        self.redis = data_proxy.redis
+
+        data_proxy.reach_cache = self
+        data_proxy.add_delta_listener(self.on_delta)
+
+    def get(self, root_uuid):
+        '''
+        :returns: (set of descendant uuids, version), or None if the root isn't materialized
+        '''
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.smembers(self.data_proxy.get_reach_key(root_uuid))
+        pipe.hget(self.data_proxy.get_reach_versions_key(), root_uuid)
+        members, version = pipe.execute()
+
+        if version is None:
+            return None
+
+        return set(m.decode() for m in members), int(version)
+
+    def materialize(self, root_node):
+        '''
+        Traverse from the root and store its descendant set, with the edges added during the
+        traversal. If another materialization of the root was stored meanwhile, that one stands.
+
+        :returns: (set of descendant uuids, version)
+        '''
+
+        root_uuid = root_node.uuid
+        reach_key = self.data_proxy.get_reach_key(root_uuid)
+        versions_key = self.data_proxy.get_reach_versions_key()
+        building_key = self.data_proxy.get_reach_building_key()
+        pending_key = self.data_proxy.get_reach_pending_key(root_uuid)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.sadd(building_key, root_uuid)
+        pipe.hget(versions_key, root_uuid)
+        _, start_version = pipe.execute()
+
+        descendants = set(root_node.query_outgoing(use_cache=False))
+        edges = []
+
+        with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(versions_key, pending_key)
+                    version = pipe.hget(versions_key, root_uuid)
+                    if version is not None and version != start_version:
+                        pipe.reset()
+                        cached = self.get(root_uuid)
+                        if cached is not None:
+                            return cached
+                        continue
+
+                    queued = pipe.lrange(pending_key, len(edges), -1)
+                    edges += [e.decode().split(':') for e in queued]
+                    self.apply_edges(root_uuid, descendants, edges)
+                    descendants.discard(root_uuid)
+
+                    pipe.multi()
+                    pipe.delete(reach_key)
+                    if descendants:
+                        pipe.sadd(reach_key, *descendants)
+                    pipe.delete(pending_key)
+                    pipe.srem(building_key, root_uuid)
+                    pipe.hincrby(versions_key, root_uuid, 1)
+                    version = pipe.execute()[-1]
+                    break
+                except WatchError:
+                    continue
+
+        return descendants, version
+
+    def apply_edges(self, root_uuid, descendants, edges):
+        '''
+        Grow descendants by the queued edges that it reaches, until none is left to apply, as an
+        edge may only be reached through one queued after it
+
+        :param edges: list of (from_uuid, to_uuid)
+        '''
+
+        grown = True
+        while grown:
+            grown = False
+            for from_uuid, to_uuid in edges:
+                reaches_from = from_uuid == root_uuid or from_uuid in descendants
+                if reaches_from and to_uuid not in descendants:
+                    descendants.update(self.get_descendants(to_uuid))
+                    grown = True
+
+    def get_or_materialize(self, root_node):
+        cached = self.get(root_node.uuid)
+        if cached is None:
+            cached = self.materialize(root_node)
+        return cached
+
+    def invalidate(self, root_uuid):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(self.data_proxy.get_reach_key(root_uuid))
+        pipe.hdel(self.data_proxy.get_reach_versions_key(), root_uuid)
+        pipe.execute()
+
+    def roots(self):
+        '''
+        :returns: (list of the materialized roots, set of the roots being materialized)
+        '''
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hkeys(self.data_proxy.get_reach_versions_key())
+        pipe.smembers(self.data_proxy.get_reach_building_key())
+        roots, building = pipe.execute()
+
+        return [r.decode() for r in roots], set(b.decode() for b in building)
+
+    def on_delta(self, action, **kwargs):
+        if action == 'AddOutgoingConnection':
+            self.add_edge(kwargs['node_uuid'], kwargs['outgoing_node_uuid'])
+
+    def add_edge(self, from_uuid, to_uuid):
+        '''
+        Grow the sets of every root that reaches from_uuid by to_uuid and its descendants
+
+        :returns: list of the roots updated
+        '''
+
+        roots, building = self.roots()
+        if building:
+            roots = self.queue_edge(from_uuid, to_uuid, roots, building)
+        if not roots:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for root_uuid in roots:
+            pipe.sismember(self.data_proxy.get_reach_key(root_uuid), from_uuid)
+            pipe.sismember(self.data_proxy.get_reach_key(root_uuid), to_uuid)
+        results = pipe.execute()
+
+        affected = []
+        for i, root_uuid in enumerate(roots):
+            reaches_from = root_uuid == from_uuid or results[i * 2]
+            reaches_to = root_uuid == to_uuid or results[i * 2 + 1]
+
+            # If to_uuid was already reachable, so was everything below it
+            if reaches_from and not reaches_to:
+                affected.append(root_uuid)
+
+        if not affected:
+            return []
+
+        # Computed once for all affected roots
+        to_descendants = self.get_descendants(to_uuid)
+
+        pipe = self.redis.pipeline(transaction=True)
+        for root_uuid in affected:
+            reach_key = self.data_proxy.get_reach_key(root_uuid)
+            pipe.sadd(reach_key, *to_descendants)
+            pipe.srem(reach_key, root_uuid)
+            pipe.hincrby(self.data_proxy.get_reach_versions_key(), root_uuid, 1)
+        pipe.execute()
+
+        return affected
+
+    def queue_edge(self, from_uuid, to_uuid, roots, building):
+        '''
+        Queue the edge for the roots being materialized. The roots whose materialization was
+        stored before the edge was queued take it like any other root.
+
+        :returns: list of the roots to grow now
+        '''
+
+        building = list(building)
+        edge = f'{from_uuid}:{to_uuid}'
+
+        pipe = self.redis.pipeline(transaction=True)
+        for root_uuid in building:
+            pipe.rpush(self.data_proxy.get_reach_pending_key(root_uuid), edge)
+            pipe.sismember(self.data_proxy.get_reach_building_key(), root_uuid)
+        results = pipe.execute()
+
+        # A root still building when its queue grew applies the edge itself
+        still_building = set(r for i, r in enumerate(building) if results[i * 2 + 1])
+        finished = set(building) - still_building
+
+        return [r for r in set(roots) | finished if r not in still_building]
+
+    def get_descendants(self, node_uuid):
+        '''
+        The node and everything below it, from its own cached set when there is one
+
+        :returns: set of uuids
+        '''
+
+        from lazy_node import LazyNode
+
+        cached = self.get(node_uuid)
+        if cached is not None:
+            descendants, _ = cached
+        else:
+            node = LazyNode(self.data_proxy, node_uuid, fields=('outgoing',))
+            descendants = set(node.query_outgoing(use_cache=False))
+
+        descendants.add(node_uuid)
+        return descendants
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+import os
+import sys
+import math
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from redis import StrictRedis
+
+from node import Node, calc_period, build_score_func
+from aggregate_signal import AggregateSignal
+from data_proxy.redis import RedisProxy
+from data_proxy.sharded import ShardedRedisProxy
+
+
+# The data proxy and aggregate of a pool worker process, see init_worker()
+worker_proxy = None
+worker_aggregate = None
+
+
+def make_proxy(shard_specs):
+    '''
+    :param shard_specs: list of 'host:port/db' strings, port and db optional
+    :returns: RedisProxy for one, ShardedRedisProxy for several
+    '''
+
+    clients = {}
+    for spec in shard_specs:
+        address, _, db = spec.partition('/')
+        host, _, port = address.partition(':')
+        clients[spec] = StrictRedis(host=host, port=int(port or 6379), db=int(db or 0))
+
+    if len(clients) == 1:
+        return RedisProxy(list(clients.values())[0])
+    return ShardedRedisProxy(clients)
+
+
+def init_worker(shard_specs):
+    global worker_proxy, worker_aggregate
+    worker_proxy = make_proxy(shard_specs)
+    worker_aggregate = AggregateSignal(worker_proxy, listen=False)
+
+
+def rescore_batch(node_uuids, anchor_timestamp, window, decay, num_points):
+    '''
+    Recompute and publish the signals of a batch of nodes, in one pipelined read and one pipelined
+    write per shard. Runs in a pool worker. Nodes that no longer score have their signal removed
+    in the same write. The aggregates the nodes belong to are updated for the whole batch.
+
+    :returns: (number of nodes, number of signals written)
+    '''
+
+    histories = worker_proxy.get_histories(node_uuids, anchor_timestamp=anchor_timestamp,
+                                           window=window, limit=num_points)
+
+    signals = {}
+    for node_uuid, history in histories.items():
+        period, time_since = calc_period(history['timestamp_epoch'], anchor_timestamp,
+                                         num_points=num_points)
+
+        signals[node_uuid] = build_score_func(period, time_since, anchor_timestamp, decay=decay)
+
+    if signals:
+        worker_proxy.publish_signals(signals)
+        worker_aggregate.update_signals(signals)
+
+    return len(node_uuids), sum(1 for s in signals.values() if s)
+
+
+class RescoreJob():
+    '''
+    Regenerate every node's NODE-SIGNAL-* after a change to the scoring parameters.
+
+    The points keys are SCANned page by page, shard by shard, and each page is rescored as one
+    batch by a pool of worker processes. The SCAN position is checkpointed in
+    RESCORE-{job_name} once every page before it has completed, so an interrupted job resumes
+    close to where it stopped. Nodes may be rescored twice across a resume, which is harmless.
+
+    :param shard_specs: list of 'host:port/db' strings, see make_proxy()
+    :param job_name: checkpoint name
+    :param workers: pool size
+    :param batch_size: SCAN page size hint, and so the batch size
+    :param window, decay, num_points: scoring parameters, defaults are Node's
+    :param report_interval: seconds between progress reports
+    '''
+
+    def __init__(self, shard_specs, job_name='default', workers=None, batch_size=1000,
+                 window=None, decay=None, num_points=None, report_interval=5):
+        self.shard_specs = shard_specs
+        self.data_proxy = make_proxy(shard_specs)
+        self.job_name = job_name
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.window = window or Node.SCORE_WINDOW
+        self.decay = Node.SCORE_DECAY if decay is None else decay
+        self.num_points = num_points or Node.SCORE_INTERVAL_POINTS
+        self.report_interval = report_interval
+
+        self.max_inflight = self.workers * 2
+        self.checkpoint_key = self.data_proxy.get_rescore_checkpoint_key(job_name)
+
+        self.state = None
+        self.start_time = None
+        self.last_report = 0
+        self.run_nodes = 0
+
+    def load_checkpoint(self):
+        checkpoint = self.data_proxy.redis.hgetall(self.checkpoint_key)
+        if not checkpoint:
+            return None
+
+        return {
+            'client': int(checkpoint[b'client']),
+            'cursor': int(checkpoint[b'cursor']),
+            'anchor_timestamp': int(checkpoint[b'anchor_timestamp']),
+            'num_nodes': int(checkpoint[b'num_nodes']),
+            'num_signals': int(checkpoint[b'num_signals'])
+        }
+
+    def save_checkpoint(self):
+        self.data_proxy.redis.hset(self.checkpoint_key, mapping=self.state)
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.last_report < self.report_interval:
+            return
+
+        elapsed = now - self.start_time
+        print('%s: %d nodes, %d signals, %.0f nodes/s' % (
+            self.job_name, self.state['num_nodes'], self.state['num_signals'],
+            self.run_nodes / elapsed if elapsed else 0))
+        self.last_report = now
+
+    def drain(self, inflight, wait_all=False):
+        '''
+        Collect completed batches in SCAN order, advancing the checkpoint past each one. Blocks on
+        the oldest batch while too many are in flight.
+        '''
+
+        while inflight:
+            client_index, next_cursor, future = inflight[0]
+            must_wait = wait_all or len(inflight) > self.max_inflight
+            if future and not future.done() and not must_wait:
+                break
+
+            inflight.popleft()
+            if future:
+                num_nodes, num_signals = future.result()
+                self.state['num_nodes'] += num_nodes
+                self.state['num_signals'] += num_signals
+                self.run_nodes += num_nodes
+
+            if next_cursor == 0:
+                client_index, next_cursor = client_index + 1, 0
+            self.state['client'] = client_index
+            self.state['cursor'] = next_cursor
+            self.save_checkpoint()
+            self.report()
+
+    def run(self, resume=True):
+        '''
+        :returns: dict of the final counters
+        '''
+
+        self.state = resume and self.load_checkpoint()
+        if not self.state:
+            self.state = {
+                'client': 0,
+                'cursor': 0,
+                'anchor_timestamp': math.ceil(time.time()),
+                'num_nodes': 0,
+                'num_signals': 0
+            }
+
+        self.start_time = self.last_report = time.time()
+        key_func = self.data_proxy.get_node_points_key
+        clients = self.data_proxy.get_clients()
+        batch_args = (self.state['anchor_timestamp'], self.window, self.decay, self.num_points)
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                 initargs=(self.shard_specs,)) as pool:
+            inflight = deque()
+
+            for client_index in range(self.state['client'], len(clients)):
+                cursor = self.state['cursor'] if client_index == self.state['client'] else 0
+                while True:
+                    cursor, keys = clients[client_index].scan(cursor, match=key_func('*'),
+                                                              count=self.batch_size)
+                    node_uuids = [self.data_proxy.parse_node_key(key_func, k) for k in keys]
+                    node_uuids = [u for u in node_uuids if u is not None]
+
+                    future = None
+                    if node_uuids:
+                        future = pool.submit(rescore_batch, node_uuids, *batch_args)
+                    inflight.append((client_index, cursor, future))
+                    self.drain(inflight)
+
+                    if cursor == 0:
+                        break
+
+            self.drain(inflight, wait_all=True)
+
+        self.report(force=True)
+        self.data_proxy.redis.delete(self.checkpoint_key)
+        return self.state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regenerate every node signal')
+    parser.add_argument('--shard', action='append',
+                        help='host:port/db, repeat for a sharded deployment')
+    parser.add_argument('--job', default='default', help='Checkpoint name')
+    parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--window', type=int, default=None)
+    parser.add_argument('--decay', type=float, default=None)
+    parser.add_argument('--interval-points', type=int, default=None)
+    args = parser.parse_args()
+
+    job = RescoreJob(args.shard or [os.environ.get('REDIS_HOST', 'redis')],
+                     job_name=args.job,
+                     workers=args.workers,
+                     batch_size=args.batch_size,
+                     window=args.window,
+                     decay=args.decay,
+                     num_points=args.interval_points)
+
+    start_time = time.time()
+    job.run(resume=not args.restart)
+    print('Done in %.1fs' % (time.time() - start_time))
+    sys.exit(0)
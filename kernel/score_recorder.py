@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import os
+import sys
+import math
+import time
+import struct
+import argparse
+import traceback
+
+from redis import StrictRedis
+
+from wave_func import WaveFunc
+
+
+def track_activity(data_proxy):
+    '''
+    Have a data proxy mark the nodes it publishes signals for as active, for the recorder. The
+    mark is written with the signal, inside the create_point script or the same pipeline, so it
+    costs no round trip. Every process publishing signals should call this on its proxy.
+    '''
+
+    data_proxy.score_activity = True
+
+
+class ScoreRecorder():
+    '''
+    Score time series per node, sampled from the published NodeSignal at fixed cadences into
+    fixed-size ring buffers, one per resolution.
+
+    A buffer (NODE-SCORES-{uuid}-{step}) is a single string: an int64 header holding the
+    absolute slot (time // step) last written, followed by `slots` float32 values. Slot s lives at
+    s % slots. Slots skipped while a node was inactive are written as NaN, so the whole series is
+    one GET and needs no other bookkeeping.
+
+    Nodes are active while they've published a signal within active_window seconds. The data
+    proxies publishing signals record that in NODE-SCORES-ACTIVE, one per client, once
+    track_activity() is called on them.
+
+    Buffers are read, then written, without a transaction: run a single recording process.
+
+    :param data_proxy: RedisProxy
+    :param resolutions: tuple of (step seconds, slots)
+    :param active_window: seconds
+    '''
+
+    # 1 minute for a day, 1 hour for a month
+    RESOLUTIONS = ((60, 1440), (3600, 720))
+
+    HEADER = struct.Struct('<q')
+    VALUE = struct.Struct('<f')
+    NAN = VALUE.pack(float('nan'))
+
+    def __init__(self, data_proxy, resolutions=None, active_window=86400 * 7):
+        self.data_proxy = data_proxy
+        self.resolutions = resolutions or self.RESOLUTIONS
+        self.active_window = active_window
+
+        # step -> last slot recorded by this process
+        self.last_slots = {}
+
+    def get_active(self, now=None):
+        '''
+        :returns: list of the uuids of the active nodes, forgetting the rest
+        '''
+
+        if now is None:
+            now = time.time()
+
+        active_key = self.data_proxy.get_score_active_key()
+
+        node_uuids = set()
+        for client in self.data_proxy.get_clients():
+            pipe = client.pipeline(transaction=False)
+            pipe.zremrangebyscore(active_key, '-inf', now - self.active_window)
+            pipe.zrange(active_key, 0, -1)
+            _, client_uuids = pipe.execute()
+            node_uuids.update(u.decode() for u in client_uuids)
+
+        return sorted(node_uuids)
+
+    def sample(self, signals, timestamp):
+        '''
+        :returns: dict of node_uuid -> score at timestamp, NaN without a signal
+        '''
+
+        values = {}
+        for node_uuid, wave_func_def in signals.items():
+            value = float('nan')
+            if wave_func_def and wave_func_def.get('period'):
+                value = WaveFunc(serialized=wave_func_def).resolve(timestamp).value
+            values[node_uuid] = value
+
+        return values
+
+    def queue_write(self, pipe, key, header, slot, slots, value):
+        '''
+        Add the commands writing one slot to a pipeline, NaN-filling any skipped slots
+
+        :param header: the buffer's current header bytes, empty if it doesn't exist
+        '''
+
+        if not header:
+            pipe.set(key, self.HEADER.pack(slot) + self.NAN * slots)
+        else:
+            last_slot = self.HEADER.unpack(header)[0]
+            if slot <= last_slot - slots:
+                # Older than the whole buffer
+                return
+
+            if slot > last_slot:
+                # The gap, wrapping at most once
+                gap_start = max(last_slot + 1, slot - slots + 1)
+                while gap_start < slot:
+                    pos = gap_start % slots
+                    run = min(slot - gap_start, slots - pos)
+                    pipe.setrange(key, self.HEADER.size + pos * self.VALUE.size, self.NAN * run)
+                    gap_start += run
+
+                pipe.setrange(key, 0, self.HEADER.pack(slot))
+
+        pipe.setrange(key, self.HEADER.size + (slot % slots) * self.VALUE.size,
+                      self.VALUE.pack(value))
+
+    def record(self, now=None):
+        '''
+        Sample every active node into each resolution whose slot has advanced since the last
+        call. One pipelined header read and one pipelined write per client and resolution.
+
+        :returns: dict of step -> number of nodes recorded
+        '''
+
+        if now is None:
+            now = time.time()
+
+        due = []
+        for step, slots in self.resolutions:
+            slot = int(now // step)
+            if self.last_slots.get(step) != slot:
+                due.append((step, slots, slot))
+
+        if not due:
+            return {}
+
+        node_uuids = self.get_active(now)
+        signals = self.data_proxy.get_signals(node_uuids) if node_uuids else {}
+
+        recorded = {}
+        for step, slots, slot in due:
+            values = self.sample(signals, slot * step)
+
+            def write(client, node_uuids):
+                keys = [self.data_proxy.get_score_series_key(u, step) for u in node_uuids]
+
+                pipe = client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.getrange(key, 0, self.HEADER.size - 1)
+                headers = pipe.execute()
+
+                pipe = client.pipeline(transaction=False)
+                for node_uuid, key, header in zip(node_uuids, keys, headers):
+                    self.queue_write(pipe, key, header, slot, slots, values[node_uuid])
+                pipe.execute()
+
+            if node_uuids:
+                self.data_proxy.map_clients(write, node_uuids)
+
+            self.last_slots[step] = slot
+            recorded[step] = len(node_uuids)
+
+        return recorded
+
+    def get_series(self, node_uuid, step):
+        '''
+        :returns: (start time, step, list of values oldest first, None where nothing was
+            recorded), or None if the node has no buffer at this resolution
+        '''
+
+        slots = dict(self.resolutions)[step]
+        key = self.data_proxy.get_score_series_key(node_uuid, step)
+        data = self.data_proxy.get_client(node_uuid).get(key)
+        if not data:
+            return None
+
+        last_slot = self.HEADER.unpack_from(data)[0]
+        first_slot = last_slot - slots + 1
+
+        values = []
+        for slot in range(first_slot, last_slot + 1):
+            value = self.VALUE.unpack_from(data, self.HEADER.size
+                                           + (slot % slots) * self.VALUE.size)[0]
+            values.append(None if math.isnan(value) else value)
+
+        return first_slot * step, step, values
+
+    def run(self, interval=None):
+        '''
+        Record forever, waking at the finest step
+        '''
+
+        if interval is None:
+            interval = min(step for step, _ in self.resolutions)
+
+        while True:
+            try:
+                recorded = self.record()
+                if recorded:
+                    print('Recorded %s' % ', '.join('%ds: %d nodes' % (step, num)
+                                                    for step, num in sorted(recorded.items())))
+            except Exception:
+                # TODO: Setup a proper log sink
+                traceback.print_exc()
+
+            time.sleep(interval - time.time() % interval)
+
+
+if __name__ == '__main__':
+    from data_proxy.redis import RedisProxy
+
+    parser = argparse.ArgumentParser(description='Record node score time series')
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'redis'))
+    args = parser.parse_args()
+
+    recorder = ScoreRecorder(RedisProxy(StrictRedis(host=args.redis_host, db=0)))
+    try:
+        recorder.run()
+    except KeyboardInterrupt:
+        sys.exit(0)
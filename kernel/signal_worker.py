@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import socket
+import argparse
+import traceback
+from multiprocessing import Process
+
+from redis import StrictRedis
+from redis.exceptions import ResponseError
+
+from node import Node
+from data_proxy.redis import RedisProxy
+from reach_cache import ReachabilityCache
+from aggregate_signal import AggregateSignal
+from score_recorder import track_activity
+
+
+class SignalWorker():
+    '''
+    Recompute node signals out of band of the write path.
+
+    Consumes the AddPoint / UpdatePoint deltas from the NODE-STREAM-* streams through a consumer
+    group, so a pool of workers shares the load and every entry is delivered to one of them.
+    Entries are acknowledged only after the signal is written (at-least-once), and all pending
+    entries for a node within one read are coalesced into a single recompute.
+
+    :param data_proxy: RedisProxy
+    :param consumer_name: Stable name within the group. Reusing a name after a crash picks up that
+        consumer's unacknowledged entries first.
+    :param batch_size: Max entries read per stream per XREADGROUP
+    :param block_ms: How long a read blocks waiting for new entries
+    :param rescan_interval: Seconds between scans for newly created node streams
+    :param claim_idle_ms: Pending entries idle this long (i.e. owned by a dead consumer) are claimed
+    :param claim_interval: Seconds between looking for such entries, by default claim_idle_ms
+    :param aggregate: Optional AggregateSignal, refreshed on every rescan. It updates itself from
+        the NodeSignal deltas this worker emits, and its membership from the AddOutgoingConnection
+        entries read here, whichever process wrote the edge.
+    :param reach_cache: Optional ReachabilityCache, grown from the same entries
+    '''
+
+    GROUP = 'signal-workers'
+    RECOMPUTE_ACTIONS = (b'AddPoint', b'UpdatePoint')
+
+    def __init__(self, data_proxy, consumer_name=None, batch_size=100, block_ms=1000,
+                 rescan_interval=5, claim_idle_ms=60000, claim_interval=None,
+                 streams_per_read=500, aggregate=None, reach_cache=None):
+        self.data_proxy = data_proxy
+        self.consumer_name = consumer_name or '%s-%s' % (socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.rescan_interval = rescan_interval
+        self.claim_idle_ms = claim_idle_ms
+        self.claim_interval = claim_interval or claim_idle_ms / 1000.0
+        self.streams_per_read = streams_per_read
+        self.aggregate = aggregate
+        self.reach_cache = reach_cache
+
+        # stream_key -> node_uuid
+        self.streams = {}
+        self.last_scan = 0
+        self.last_claim = 0
+
+        self.num_recomputed = 0
+        self.num_acked = 0
+
+    def __repr__(self):
+        return '<SignalWorker %s>' % self.consumer_name
+
+    def scan_streams(self):
+        '''
+        Discover node streams and make sure the consumer group exists on each of them
+
+        :returns: list of newly discovered stream keys
+        '''
+
+        new_streams = []
+        for node_uuid, stream_key in self.data_proxy.scan_node_streams():
+            if stream_key in self.streams:
+                continue
+
+            try:
+                # Start from the beginning so existing history produces an initial signal
+                client = self.data_proxy.get_client(node_uuid)
+                client.xgroup_create(stream_key, self.GROUP, id='0')
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+            self.streams[stream_key] = node_uuid
+            new_streams.append(stream_key)
+
+        self.last_scan = time.time()
+        return new_streams
+
+    def claim_stale(self):
+        '''
+        Take over entries left pending by consumers that stopped acknowledging. A pipelined
+        XPENDING summary of every stream finds those with entries pending on other consumers, and
+        only they are inspected and claimed, in pipelines per client.
+
+        :returns: number of entries claimed
+        '''
+
+        node_streams = dict((node_uuid, k) for k, node_uuid in self.streams.items())
+        consumer_name = self.consumer_name.encode()
+
+        def claim(client, node_uuids):
+            num_claimed = 0
+            for i in range(0, len(node_uuids), self.streams_per_read):
+                stream_keys = [node_streams[u] for u in node_uuids[i:i + self.streams_per_read]]
+
+                pipe = client.pipeline(transaction=False)
+                for stream_key in stream_keys:
+                    pipe.xpending(stream_key, self.GROUP)
+
+                # Streams deleted since the scan fail with NOGROUP
+                summaries = pipe.execute(raise_on_error=False)
+                candidates = [k for k, summary in zip(stream_keys, summaries)
+                              if isinstance(summary, dict) and summary['pending'] and
+                              any(c['name'] != consumer_name for c in summary['consumers'])]
+                if not candidates:
+                    continue
+
+                pipe = client.pipeline(transaction=False)
+                for stream_key in candidates:
+                    pipe.xpending_range(stream_key, self.GROUP,
+                                        min='-', max='+', count=self.batch_size)
+
+                claim_pipe = client.pipeline(transaction=False)
+                for stream_key, pending in zip(candidates, pipe.execute()):
+                    stale_ids = [p['message_id'] for p in pending
+                                 if p['time_since_delivered'] >= self.claim_idle_ms and
+                                 p['consumer'] != consumer_name]
+                    if stale_ids:
+                        claim_pipe.xclaim(stream_key, self.GROUP, self.consumer_name,
+                                          self.claim_idle_ms, stale_ids)
+                        num_claimed += len(stale_ids)
+
+                claim_pipe.execute()
+
+            return num_claimed
+
+        self.last_claim = time.time()
+        return sum(self.data_proxy.map_clients(claim, list(node_streams)))
+
+    def read(self, stream_id='>', block=None):
+        '''
+        Read from every known stream, in chunks per client
+
+        :param stream_id: '>' for new entries, '0' for this consumer's pending entries
+        :returns: list of (stream_key, entries)
+        '''
+
+        node_streams = dict((node_uuid, k) for k, node_uuid in self.streams.items())
+
+        chunks = []
+        for client, node_uuids in self.data_proxy.group_by_client(node_streams):
+            stream_keys = [node_streams[node_uuid] for node_uuid in node_uuids]
+            for i in range(0, len(stream_keys), self.streams_per_read):
+                chunks.append((client, stream_keys[i:i + self.streams_per_read]))
+
+        result = []
+        for i, (client, stream_keys) in enumerate(chunks):
+            streams = dict((k, stream_id) for k in stream_keys)
+
+            # Only the last chunk blocks, and only if nothing has arrived yet
+            last_chunk = i == len(chunks) - 1
+            chunk_block = block if last_chunk and not result else None
+
+            chunk_result = client.xreadgroup(self.GROUP, self.consumer_name, streams,
+                                             count=self.batch_size, block=chunk_block)
+            if chunk_result:
+                result.extend(chunk_result)
+
+        return result
+
+    def add_edges(self, node_uuid, outgoing_node_uuids):
+        '''
+        Apply new outgoing connections of a node to the derived structures kept here
+        '''
+
+        for outgoing_node_uuid in outgoing_node_uuids:
+            if self.reach_cache:
+                self.reach_cache.add_edge(node_uuid, outgoing_node_uuid)
+            if self.aggregate:
+                self.aggregate.add_edge(node_uuid, outgoing_node_uuid)
+
+    def process(self, read_result):
+        '''
+        Recompute once per node with point activity, apply its new outgoing connections, then
+        acknowledge everything that was read
+
+        :returns: number of nodes recomputed
+        '''
+
+        num_recomputed = 0
+        for stream_key, entries in read_result:
+            if type(stream_key) is bytes:
+                stream_key = stream_key.decode()
+
+            if not entries:
+                continue
+
+            node_uuid = self.streams.get(stream_key)
+            entry_ids = [entry_id for entry_id, _ in entries]
+
+            # Entries claimed or re-read from the PEL may have been deleted (None fields)
+            recompute = any(fields and fields.get(b'action') in self.RECOMPUTE_ACTIONS
+                            for _, fields in entries)
+
+            outgoing_node_uuids = [fields[b'outgoing_node_uuid'].decode() for _, fields in entries
+                                   if fields and fields.get(b'action') == b'AddOutgoingConnection']
+            if outgoing_node_uuids:
+                try:
+                    self.add_edges(node_uuid, outgoing_node_uuids)
+                except Exception:
+                    # TODO: Setup a proper log sink
+                    traceback.print_exc()
+                    continue
+
+            if recompute:
+                try:
+                    node = Node(self.data_proxy, uuid=node_uuid, load=False)
+                    node.update_signal()
+                except Exception:
+                    # Leave the entries pending, they'll be retried or claimed
+                    # TODO: Setup a proper log sink
+                    traceback.print_exc()
+                    continue
+
+                num_recomputed += 1
+
+            client = self.data_proxy.get_client(node_uuid)
+            client.xack(stream_key, self.GROUP, *entry_ids)
+            self.num_acked += len(entry_ids)
+
+        self.num_recomputed += num_recomputed
+        return num_recomputed
+
+    def run(self):
+        self.scan_streams()
+        self.claim_stale()
+
+        # Finish whatever this consumer had in flight before a restart
+        self.process(self.read('0'))
+
+        while True:
+            if time.time() - self.last_scan > self.rescan_interval:
+                self.scan_streams()
+
+                if time.time() - self.last_claim > self.claim_interval:
+                    self.claim_stale()
+                    self.process(self.read('0'))
+
+                if self.aggregate:
+                    self.aggregate.refresh()
+
+            if not self.streams:
+                time.sleep(self.block_ms / 1000.0)
+                continue
+
+            self.process(self.read('>', block=self.block_ms))
+
+
+def run_worker(index, redis_host, redis_port, redis_db):
+    redis = StrictRedis(host=redis_host, port=redis_port, db=redis_db)
+    consumer_name = '%s-%d' % (socket.gethostname(), index)
+    data_proxy = RedisProxy(redis)
+    worker = SignalWorker(data_proxy, consumer_name=consumer_name,
+                          aggregate=AggregateSignal(data_proxy),
+                          reach_cache=ReachabilityCache(data_proxy))
+
+    # Marks the nodes this worker publishes signals for as active, for the score recorder
+    track_activity(data_proxy)
+    print('Starting %s' % worker)
+    worker.run()
+
+
+def run_pool(num_workers, redis_host='redis', redis_port=6379, redis_db=0):
+    processes = []
+    for i in range(num_workers):
+        p = Process(target=run_worker, args=(i, redis_host, redis_port, redis_db))
+        p.daemon = True
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Node signal recomputation workers')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'redis'))
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-db', type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        run_pool(args.workers, args.redis_host, args.redis_port, args.redis_db)
+    except KeyboardInterrupt:
+        sys.exit(0)